@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# track_api starts a tracker at import time; keep it away from the real ~/.wakatime.cfg and ~/.unitime
+os.environ['HOME'] = tempfile.mkdtemp(prefix='unitime-home-')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,142 @@
+import os
+import threading
+import time
+
+import pytest
+from watchdog.events import FileSystemEventHandler
+
+import track_api
+
+# Above the default fs.inotify.max_user_instances of 128
+DIRECTORY_COUNT = 300
+
+
+class RecordingHandler(FileSystemEventHandler):
+    def __init__(self):
+        self.paths = []
+
+    def on_any_event(self, event):
+        self.paths.append(event.src_path)
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return predicate()
+
+
+def inotify_instances():
+    count = 0
+    for fd in os.listdir('/proc/self/fd'):
+        try:
+            count += os.readlink(os.path.join('/proc/self/fd', fd)) == 'anon_inode:inotify'
+        except OSError:
+            pass
+    return count
+
+
+@pytest.fixture
+def project(tmp_path):
+    directories = []
+    for i in range(DIRECTORY_COUNT):
+        directory = tmp_path / f'pkg{i // 20}' / f'mod{i}'
+        directory.mkdir(parents=True)
+        directories.append(str(directory))
+    return str(tmp_path), directories
+
+
+def test_watcher_uses_one_inotify_instance_for_many_directories(project):
+    root, directories = project
+    handler = RecordingHandler()
+    before = inotify_instances() if track_api.InotifyBuffer is not None else 0
+    watcher = track_api.DirectoryWatcher(root, handler)
+    try:
+        for directory in directories:
+            watcher.add(os.path.dirname(directory))
+            watcher.add(directory)
+        if track_api.InotifyBuffer is not None:
+            assert inotify_instances() - before == 1
+        assert len(watcher.directories) == DIRECTORY_COUNT + DIRECTORY_COUNT // 20 + 1
+
+        target = os.path.join(directories[-1], 'last.py')
+        with open(target, 'w') as f:
+            f.write('x = 1\n')
+        assert wait_for(lambda: target in handler.paths)
+    finally:
+        watcher.stop()
+
+
+def test_watcher_drops_events_from_unwatched_directories(project):
+    root, directories = project
+    handler = RecordingHandler()
+    watcher = track_api.DirectoryWatcher(root, handler)
+    try:
+        watcher.add(os.path.dirname(directories[0]))
+        watcher.add(directories[0])
+        watcher.remove_tree(os.path.dirname(directories[0]))
+        ignored = os.path.join(directories[0], 'ignored.py')
+        with open(ignored, 'w') as f:
+            f.write('x = 1\n')
+        watched = os.path.join(root, 'top.py')
+        with open(watched, 'w') as f:
+            f.write('x = 1\n')
+        assert wait_for(lambda: watched in handler.paths)
+        assert ignored not in handler.paths
+    finally:
+        watcher.stop()
+
+
+def test_tracker_watches_every_directory_of_a_large_project(project):
+    root, directories = project
+    tracker = track_api.tracker
+    assert tracker.add_directory(root)
+    try:
+        assert wait_for(lambda: tracker.scan_stats.get(root, {}).get('state') == 'complete', timeout=30)
+        assert tracker.get_stats()['watches'][root] == DIRECTORY_COUNT + DIRECTORY_COUNT // 20 + 1
+
+        queued = []
+        original = tracker.queue_file_change
+        tracker.queue_file_change = lambda file_path, is_write=False: queued.append(file_path)
+        try:
+            target = os.path.join(directories[-1], 'edited.py')
+            with open(target, 'w') as f:
+                f.write('x = 1\n')
+            assert wait_for(lambda: target in queued)
+        finally:
+            tracker.queue_file_change = original
+    finally:
+        tracker.remove_directory(root)
+
+
+class BufferWithoutInternals:
+    """Stands in for an InotifyBuffer from a watchdog release that renamed its private inotify handle"""
+    def __init__(self, path):
+        self.closed = threading.Event()
+
+    def read_event(self):
+        self.closed.wait()
+        return None
+
+    def close(self):
+        self.closed.set()
+
+
+def test_watcher_falls_back_when_inotify_internals_change(project, monkeypatch):
+    root, directories = project
+    monkeypatch.setattr(track_api, 'InotifyBuffer', BufferWithoutInternals)
+    handler = RecordingHandler()
+    watcher = track_api.DirectoryWatcher(root, handler)
+    try:
+        watcher.add(os.path.dirname(directories[0]))
+        watcher.add(directories[0])
+        assert watcher.inotify is None and watcher.observer is not None
+
+        target = os.path.join(directories[0], 'after_fallback.py')
+        with open(target, 'w') as f:
+            f.write('x = 1\n')
+        assert wait_for(lambda: target in handler.paths)
+    finally:
+        watcher.stop()
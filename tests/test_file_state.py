@@ -0,0 +1,51 @@
+import time
+
+import track_api
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return condition()
+
+
+def tracked_files(tracker):
+    return tracker.get_stats()['tracked_files']
+
+
+def scan(tracker, root):
+    assert tracker.add_directory(root)
+    assert wait_for(lambda: tracker.scan_stats.get(root, {}).get('state') == 'complete')
+
+
+def test_untracked_and_deleted_trees_stop_counting_evicted_files(tmp_path, monkeypatch):
+    tracker = track_api.tracker
+    root = tmp_path / 'project'
+    for package in ('core', 'extra'):
+        (root / package).mkdir(parents=True)
+        for index in range(40):
+            (root / package / f'module_{index}.py').write_text(f'value = {index}\n')
+    root = str(root)
+    # A small table forces most of the scanned files out to the index
+    monkeypatch.setattr(tracker, 'max_file_entries', len(tracker.file_table) + 16)
+    before = tracked_files(tracker)
+
+    scan(tracker, root)
+    assert tracker.cold_files > 0
+    assert tracked_files(tracker) == before + 80
+
+    tracker.remove_directory(root)
+    assert tracked_files(tracker) == before
+
+    # Re-tracking reuses the index and must not count the files twice
+    scan(tracker, root)
+    assert tracked_files(tracker) == before + 80
+    try:
+        tracker.handle_directory_removed(root, str(tmp_path / 'project' / 'extra'))
+        assert tracked_files(tracker) == before + 40
+    finally:
+        tracker.remove_directory(root)
+    assert tracked_files(tracker) == before
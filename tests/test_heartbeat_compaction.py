@@ -0,0 +1,61 @@
+import contextlib
+
+import pytest
+
+import track_api
+
+
+@contextlib.contextmanager
+def isolated_queue(tracker):
+    """Give the test an empty queue, holding the lock so the sender cannot flush it meanwhile"""
+    with tracker.lock:
+        saved = tracker.heartbeat_queue, tracker.pending_heartbeat_count, dict(tracker.compaction_stats)
+        tracker.heartbeat_queue, tracker.pending_heartbeat_count = {}, 0
+        tracker.compaction_stats.update(queued=0, compacted=0)
+        try:
+            yield tracker.heartbeat_queue
+        finally:
+            tracker.heartbeat_queue, tracker.pending_heartbeat_count, stats = saved
+            tracker.compaction_stats.update(stats)
+
+
+def enqueue(tracker, writes, path_id=1):
+    for second, is_write in enumerate(writes):
+        tracker._enqueue_heartbeat(path_id, track_api.Heartbeat(time=1000 + second, is_write=is_write))
+
+
+def shape(run):
+    return [(heartbeat.time - 1000, heartbeat.is_write) for heartbeat in run]
+
+
+def test_span_keeps_the_first_and_last_heartbeat_of_each_run(monkeypatch):
+    tracker = track_api.tracker
+    monkeypatch.setattr(tracker.config, 'heartbeat_compaction', 'span')
+    with isolated_queue(tracker) as queue:
+        enqueue(tracker, [False, False, False, False, True, True, True, False])
+        assert shape(queue[1]) == [(0, False), (3, False), (4, True), (6, True), (7, False)]
+        assert tracker.pending_heartbeat_count == 5
+        assert tracker.compaction_stats['compacted'] == 3
+
+
+def test_span_never_merges_runs_of_different_files(monkeypatch):
+    tracker = track_api.tracker
+    monkeypatch.setattr(tracker.config, 'heartbeat_compaction', 'span')
+    with isolated_queue(tracker) as queue:
+        enqueue(tracker, [False, False, False], path_id=1)
+        enqueue(tracker, [False, False, False], path_id=2)
+        assert shape(queue[1]) == shape(queue[2]) == [(0, False), (2, False)]
+        assert tracker.pending_heartbeat_count == 4
+
+
+@pytest.mark.parametrize('mode, expected', [
+    ('latest', [(3, True)]),
+    ('all', [(0, False), (1, False), (2, True), (3, True)]),
+])
+def test_other_compaction_modes(monkeypatch, mode, expected):
+    tracker = track_api.tracker
+    monkeypatch.setattr(tracker.config, 'heartbeat_compaction', mode)
+    with isolated_queue(tracker) as queue:
+        enqueue(tracker, [False, False, True, True])
+        assert shape(queue[1]) == expected
+        assert tracker.pending_heartbeat_count == len(expected)
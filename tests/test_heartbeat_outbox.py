@@ -0,0 +1,88 @@
+import time
+
+import track_api
+
+
+def payloads(outbox, limit=100):
+    return [payload for _, payload in outbox.peek(limit)]
+
+
+def test_peek_returns_the_oldest_heartbeats_first_across_restarts(tmp_path):
+    db_path = str(tmp_path / 'outbox.db')
+    now = time.time()
+    outbox = track_api.HeartbeatOutbox(db_path)
+    outbox.put_many([(now - 10, b'second'), (now - 20, b'first')])
+    outbox.put_many([(now - 10, b'third')])
+    outbox.close()
+
+    reopened = track_api.HeartbeatOutbox(db_path)
+    assert len(reopened) == 3
+    assert payloads(reopened) == [b'first', b'second', b'third']
+    assert payloads(reopened, 2) == [b'first', b'second']
+    reopened.close()
+
+
+def test_acknowledge_deletes_only_the_given_rows(tmp_path):
+    outbox = track_api.HeartbeatOutbox(str(tmp_path / 'outbox.db'))
+    now = time.time()
+    outbox.put_many([(now + index, f'hb{index}'.encode()) for index in range(4)])
+    ids = [row_id for row_id, _ in outbox.peek(4)]
+
+    outbox.acknowledge([ids[0], ids[2]], [ids[3]])
+    assert payloads(outbox) == [b'hb1']
+    assert len(outbox) == 1
+    stats = outbox.get_stats()
+    assert (stats['acknowledged'], stats['rejected'], stats['pending']) == (2, 1, 1)
+    outbox.close()
+
+
+def test_prune_drops_expired_then_oldest_beyond_the_limit(tmp_path):
+    outbox = track_api.HeartbeatOutbox(str(tmp_path / 'outbox.db'), max_entries=3, max_age_days=1)
+    now = time.time()
+    outbox.put_many([(now - 2 * 86400, b'expired')] + [(now + index, f'hb{index}'.encode()) for index in range(5)])
+
+    assert payloads(outbox) == [b'hb2', b'hb3', b'hb4']
+    assert len(outbox) == 3
+    assert outbox.get_stats()['expired'] == 3
+    outbox.close()
+
+
+def test_unavailable_database_keeps_heartbeats_in_memory(tmp_path):
+    blocker = tmp_path / 'not-a-directory'
+    blocker.write_text('')
+    outbox = track_api.HeartbeatOutbox(str(blocker / 'outbox.db'), max_entries=2)
+    assert outbox.conn is None
+    now = time.time()
+    outbox.put_many([(now, b'b'), (now - 1, b'a'), (now + 1, b'c')])
+
+    # The size limit applies to memory rows too
+    assert payloads(outbox) == [b'b', b'c']
+    ids = [row_id for row_id, _ in outbox.peek(2)]
+    assert all(row_id < 0 for row_id in ids)
+    outbox.acknowledge(ids[:1], [])
+    assert payloads(outbox) == [b'c'] and len(outbox) == 1
+    assert outbox.get_stats()['durable'] is False
+
+
+def test_failed_write_spills_to_memory_and_is_retried(tmp_path):
+    outbox = track_api.HeartbeatOutbox(str(tmp_path / 'outbox.db'))
+    now = time.time()
+    outbox.put_many([(now - 3, b'stored')])
+    table = outbox.conn.execute("SELECT sql FROM sqlite_master WHERE name = 'heartbeats'").fetchone()[0]
+    rows = outbox.conn.execute('SELECT time, payload FROM heartbeats').fetchall()
+    outbox.conn.execute('DROP TABLE heartbeats')
+
+    outbox.put_many([(now - 2, b'spilled')])
+    assert len(outbox) == 2
+    assert payloads(outbox) == [b'spilled']
+    assert outbox.get_stats()['durable'] is False
+
+    outbox.conn.execute(table)
+    outbox.conn.executemany('INSERT INTO heartbeats (time, payload) VALUES (?, ?)', rows)
+    outbox.conn.commit()
+    # The next successful write carries the spilled rows along
+    outbox.put_many([(now - 1, b'later')])
+    assert outbox.memory == []
+    assert payloads(outbox) == [b'stored', b'spilled', b'later']
+    assert outbox.get_stats()['durable'] is True
+    outbox.close()
@@ -0,0 +1,89 @@
+import re
+
+import track_api
+
+
+def ignored(lines, relative_path, is_dir=False):
+    return track_api.IgnoreRules(lines).match(relative_path, is_dir)
+
+
+def glob_matches(pattern, path):
+    return re.compile(track_api._glob_to_regex(pattern) + '$').match(path) is not None
+
+
+def test_glob_wildcards_stay_within_one_component():
+    assert glob_matches('src/*.py', 'src/app.py')
+    assert not glob_matches('src/*.py', 'src/pkg/app.py')
+    assert glob_matches('file?.[!a-c]', 'file1.d')
+    assert not glob_matches('file?.[!a-c]', 'file1.b')
+    assert glob_matches('[unclosed', '[unclosed')
+
+
+def test_double_star_matches_any_depth():
+    assert ignored(['**/tmp'], 'tmp', True)
+    assert ignored(['**/tmp'], 'a/b/tmp', True)
+    assert ignored(['docs/**/draft.md'], 'docs/draft.md')
+    assert ignored(['docs/**/draft.md'], 'docs/a/b/draft.md')
+    assert ignored(['logs/**'], 'logs/2024/app.log')
+    assert ignored(['logs/**'], 'other/logs/app.log') is None
+
+
+def test_patterns_with_a_slash_are_anchored():
+    assert ignored(['/build'], 'build', True)
+    assert ignored(['/build'], 'src/build', True) is None
+    assert ignored(['build'], 'src/build', True)
+    assert ignored(['docs/*.md'], 'docs/index.md')
+    assert ignored(['docs/*.md'], 'site/docs/index.md') is None
+
+
+def test_trailing_slash_only_matches_directories():
+    assert ignored(['cache/'], 'cache', True)
+    assert ignored(['cache/'], 'cache') is None
+    assert ignored(['cache/'], 'src/cache', True)
+
+
+def test_later_negation_re_includes():
+    lines = ['*.log', '!keep.log']
+    assert ignored(lines, 'debug.log')
+    assert ignored(lines, 'keep.log') is False
+    # The last matching pattern wins
+    assert ignored(['!keep.log', '*.log'], 'keep.log')
+
+
+def test_comments_blank_lines_and_escapes():
+    assert track_api.IgnoreRules(['# comment\n', '\n', '   \n']).patterns == []
+    assert ignored(['\\#notes'], '#notes')
+    assert ignored(['\\!important'], '!important')
+    assert ignored(['trailing\\ '], 'trailing ')
+    assert ignored(['spaces   '], 'spaces')
+
+
+def test_engine_honors_nested_ignore_files(tmp_path):
+    (tmp_path / '.gitignore').write_text('*.log\nvendor/\n')
+    (tmp_path / 'pkg').mkdir()
+    (tmp_path / 'pkg' / '.unitimeignore').write_text('!keep.log\n')
+    engine = track_api.IgnoreEngine(str(tmp_path))
+
+    assert engine.is_ignored(str(tmp_path / 'app.log'))
+    assert not engine.is_ignored(str(tmp_path / 'pkg' / 'keep.log'))
+    assert engine.is_ignored(str(tmp_path / 'pkg' / 'other.log'))
+    assert not engine.is_ignored(str(tmp_path / 'pkg' / 'app.py'))
+    assert engine.is_ignored(str(tmp_path / '.env'))
+
+
+def test_files_under_an_ignored_directory_cannot_be_re_included(tmp_path):
+    (tmp_path / '.gitignore').write_text('vendor/\n!vendor/lib.py\n')
+    engine = track_api.IgnoreEngine(str(tmp_path))
+
+    assert engine.is_ignored(str(tmp_path / 'vendor'), True)
+    assert engine.is_ignored(str(tmp_path / 'vendor' / 'lib.py'))
+
+
+def test_invalidate_rereads_the_ignore_file(tmp_path):
+    (tmp_path / '.gitignore').write_text('*.tmp\n')
+    engine = track_api.IgnoreEngine(str(tmp_path))
+    assert engine.is_ignored(str(tmp_path / 'a.tmp'))
+
+    (tmp_path / '.gitignore').write_text('')
+    engine.invalidate(str(tmp_path))
+    assert not engine.is_ignored(str(tmp_path / 'a.tmp'))
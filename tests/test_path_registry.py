@@ -0,0 +1,95 @@
+import os
+import threading
+
+import track_api
+
+
+def test_released_ids_are_reused_after_reclaim():
+    registry = track_api.PathRegistry()
+    first = registry.intern('/src/app/a.py')
+    registry.intern('/src/app/b.py')
+    nodes = len(registry)
+
+    registry.release('/src/app')
+    assert registry.lookup('/src/app/a.py') is None
+    # Released ids keep resolving until they are reclaimed
+    assert registry.path(first) == '/src/app/a.py'
+
+    released = registry.take_released()
+    registry.reclaim(released)
+    assert registry.intern('/src/lib/c.py') in released
+    assert len(registry) == nodes - 1
+
+
+def test_move_keeps_ids_and_prunes_empty_directories():
+    registry = track_api.PathRegistry()
+    moved = registry.intern('/src/old/deep/a.py')
+    registry.intern('/src/keep.py')
+
+    assert registry.move('/src/old/deep/a.py', '/src/new/a.py') == moved
+    assert registry.path(moved) == '/src/new/a.py'
+    assert registry.lookup('/src/old') is None
+    assert registry.lookup('/src/keep.py') is not None
+
+
+def test_lookup_after_directory_is_released_and_recreated():
+    registry = track_api.PathRegistry()
+    registry.intern('/src/app/a.py')
+    registry.intern('/src/app/b.py')
+    registry.release('/src/app')
+    registry.reclaim(registry.take_released())
+    assert registry.lookup('/src/app/a.py') is None
+
+    # Reused ids must not be found through a stale cached directory
+    recreated = registry.intern('/src/other/c.py')
+    assert registry.lookup('/src/app/c.py') is None
+    assert registry.lookup('/src/other/c.py') == recreated
+
+
+def test_names_that_are_not_valid_utf8_round_trip():
+    registry = track_api.PathRegistry()
+    path = '/src/caf\udce9.py'
+    node = registry.intern(path)
+    assert registry.lookup(path) == node
+    assert registry.path(node) == path
+
+
+def test_heartbeat_for_file_released_mid_read_is_dropped(tmp_path):
+    tracker = track_api.tracker
+    directory = tmp_path / 'pkg'
+    directory.mkdir()
+    target = directory / 'module.py'
+    target.write_text('x = 1\n')
+    target = str(target)
+
+    reading, resume = threading.Event(), threading.Event()
+    original = tracker._inspect_file
+
+    def paused_inspect(file_path):
+        reading.set()
+        resume.wait(5)
+        return original(file_path)
+
+    tracker._inspect_file = paused_inspect
+    try:
+        worker = threading.Thread(target=tracker.handle_file_change, args=(target, True))
+        worker.start()
+        assert reading.wait(5)
+        stale_id = tracker.path_registry.lookup(target)
+
+        # The parent directory moves out of the tree and a flush reclaims its ids
+        tracker._forget_tree_state(str(directory))
+        tracker._persist_heartbeat_queue()
+        other = str(tmp_path / 'other' / 'reused.py')
+        tracker.path_registry.intern(other)
+
+        resume.set()
+        worker.join(5)
+    finally:
+        tracker._inspect_file = original
+
+    with tracker.lock:
+        queued = [heartbeat for run in tracker.heartbeat_queue.values() for heartbeat in run]
+    entities = {tracker._heartbeat_entity(heartbeat) for heartbeat in queued}
+    assert target not in entities and other not in entities and '' not in entities
+    assert stale_id not in tracker.heartbeat_queue
@@ -0,0 +1,85 @@
+import track_api
+
+
+def open_breaker(policy):
+    for _ in range(policy.failure_threshold):
+        policy.record_failure()
+    assert policy.state == policy.OPEN
+
+
+def cool_down(policy):
+    """Skip the rest of the current backoff without touching the clock other threads use"""
+    policy.next_attempt = 0.0
+
+
+def test_backoff_doubles_with_equal_jitter_up_to_the_cap():
+    policy = track_api.SendPolicy(base_delay=10, max_delay=40, failure_threshold=100)
+    for expected in (10, 20, 40, 40):
+        policy.record_failure()
+        assert expected / 2 - 0.5 <= policy.retry_in() <= expected
+        assert not policy.allow()
+        cool_down(policy)
+    assert policy.state == policy.CLOSED
+    assert policy.stats['deferred'] == 4
+
+
+def test_retry_after_extends_the_delay_but_not_past_the_cap():
+    policy = track_api.SendPolicy(base_delay=1, max_delay=300, failure_threshold=100)
+    policy.record_failure(retry_after=120)
+    assert 119 <= policy.retry_in() <= 120
+    policy.record_failure(retry_after=3600)
+    assert 299 <= policy.retry_in() <= 300
+
+
+def test_breaker_opens_at_the_threshold_and_lets_one_probe_through():
+    policy = track_api.SendPolicy(base_delay=10, max_delay=600, failure_threshold=3)
+    policy.record_failure()
+    policy.record_failure()
+    assert policy.state == policy.CLOSED
+    policy.record_failure()
+    assert policy.state == policy.OPEN and policy.stats['opened'] == 1
+
+    cool_down(policy)
+    assert policy.allow()
+    assert policy.probing()
+    # A failed probe reopens at once with a longer delay
+    policy.record_failure()
+    assert policy.state == policy.OPEN and policy.stats['opened'] == 2
+    assert policy.retry_in() >= 40
+
+    cool_down(policy)
+    assert policy.allow() and policy.probing()
+    policy.record_success()
+    assert policy.state == policy.CLOSED
+    assert policy.consecutive_failures == 0 and policy.retry_in() == 0
+    assert not policy.probing()
+
+
+def test_reset_closes_the_breaker_and_clears_the_backoff():
+    policy = track_api.SendPolicy(base_delay=60, max_delay=600, failure_threshold=2)
+    open_breaker(policy)
+    assert not policy.allow()
+
+    policy.reset()
+    assert policy.state == policy.CLOSED
+    assert policy.consecutive_failures == 0
+    assert policy.retry_in() == 0
+    assert policy.allow()
+
+
+def test_changing_the_api_key_resets_the_send_policy(monkeypatch):
+    tracker = track_api.tracker
+    monkeypatch.setattr(track_api.config, 'save_wakatime_config', lambda: None)
+    monkeypatch.setattr(track_api.config, 'api_key', 'old-key')
+    # Keep the shared tracker's sender away from the real API
+    monkeypatch.setattr(track_api.config, 'api_url', 'http://127.0.0.1:9')
+    monkeypatch.setattr(track_api.config, 'project', track_api.config.project)
+    open_breaker(tracker.send_policy)
+    client = track_api.app.test_client()
+
+    client.post('/api/config', json={'project': 'unchanged-credentials'})
+    assert tracker.send_policy.state == tracker.send_policy.OPEN
+
+    client.post('/api/config', json={'api_key': 'new-key'})
+    assert tracker.send_policy.state == tracker.send_policy.CLOSED
+    assert tracker.send_policy.retry_in() == 0
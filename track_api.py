@@ -1,18 +1,42 @@
 import os
+import sys
 import time
 import json
 import threading
 import hashlib
+import gzip
+import heapq
+import itertools
+import random
+from collections import OrderedDict, deque
 import platform
+import re
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Dict, Set, Optional, List
-from dataclasses import dataclass, asdict
+from typing import Dict, Set, Optional, List, Tuple
+from dataclasses import dataclass
+from types import MappingProxyType
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+from watchdog.observers.api import ObservedWatch
+from watchdog.events import (FileSystemEventHandler, FileCreatedEvent, FileDeletedEvent, FileModifiedEvent,
+                             FileMovedEvent, DirCreatedEvent, DirDeletedEvent, DirMovedEvent)
 import requests
 from flask import Flask, request, jsonify
 import configparser
+from array import array
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    from watchdog.observers.inotify_buffer import InotifyBuffer
+except Exception:  # inotify is Linux-only; watchdog raises its own error type elsewhere
+    InotifyBuffer = None
 
 API_BASE_URL = "https://hackatime.hackclub.com/api/v1"
 PLUGIN_NAME = "unitime-wakatime"
@@ -20,11 +44,54 @@ PLUGIN_VERSION = "0.1.0"
 EDITOR_NAME = ""
 WAKATIME_CONFIG_FILE = os.path.expanduser("~/.wakatime.cfg")
 TRACKER_CONFIG_FILE = os.path.expanduser("~/.hackatime_tracker.cfg")
+UNITIME_DIR = os.path.expanduser("~/.unitime")
+FILE_INDEX_FILE = os.path.join(UNITIME_DIR, "file_index.db")
+OUTBOX_FILE = os.path.join(UNITIME_DIR, "outbox.db")
 DEFAULT_HEARTBEAT_INTERVAL = 30
 ACTIVITY_TIMEOUT = 120
+DEFAULT_SETTLE_WINDOW = 0.5
+# A path that never goes quiet is still dispatched once this many settle windows have passed
+SETTLE_MAX_DELAY_FACTOR = 5
+DEFAULT_EVENT_WORKERS = 2
+DEFAULT_EVENT_QUEUE_SIZE = 4096
+DEFAULT_MEMORY_BUDGET_MB = 128
+# latest: newest heartbeat per file per flush, span: first and last of each is_write run, all: no compaction
+COMPACTION_MODES = ('latest', 'span', 'all')
+DEFAULT_COMPACTION = 'span'
+DEFAULT_HEARTBEAT_BATCH_SIZE = 25
+# Responses meaning the server has no heartbeats.bulk endpoint at all
+BULK_UNSUPPORTED_STATUSES = (404, 405, 501)
+SENDER_POOL_SIZE = 4
+GZIP_MIN_BYTES = 4096
+DEFAULT_OUTBOX_MAX_ENTRIES = 100000
+DEFAULT_OUTBOX_MAX_AGE_DAYS = 14.0
+# Client errors worth retrying later rather than dropping the heartbeat
+RETRYABLE_CLIENT_STATUSES = (401, 403, 408, 429)
+BACKOFF_BASE_SECONDS = 2.0
+BACKOFF_MAX_SECONDS = 600.0
+BREAKER_FAILURE_THRESHOLD = 5
+SHUTDOWN_FLUSH_TIMEOUT = 15
+# Measured per-file cost of a path registry node plus its digest table row
+FILE_STATE_ENTRY_BYTES = 96
+RECENT_HEARTBEATS_LIMIT = 50
 MAX_FILE_SIZE = 2 * 1024 * 1024
+HASH_CHUNK_SIZE = 256 * 1024
+SNIFF_SIZE = 4096
+LANGUAGE_CACHE_SIZE = 8192
+LINE_SNAPSHOT_MAX_BYTES = 1024 * 1024
+IGNORE_FILES = ('.gitignore', '.ignore', '.unitimeignore')
+SKIP_EXTENSIONS = frozenset({
+    '.exe', '.dll', '.so', '.dylib', '.bin', '.obj', '.o',
+    '.jpg', '.jpeg', '.png', '.gif', '.bmp', '.ico', '.svg',
+    '.mp3', '.mp4', '.avi', '.mov', '.wav', '.flac',
+    '.zip', '.tar', '.gz', '.7z', '.rar',
+    '.pdf', '.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx'
+})
+PROJECT_FILE = '.wakatime-project'
+SCAN_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+SCAN_BATCH_SIZE = 256
 
-def detect_runtime_info():
+def detect_runtime_info(probe_runtimes: bool = True):
     info = {}
     
     info['os_name'] = platform.system().lower()
@@ -37,9 +104,13 @@ def detect_runtime_info():
     except (AttributeError, ImportError):
         pass
     
+    if not probe_runtimes:
+        info.setdefault('runtime', "unknown-runtime")
+        return info
+    
     try:
         import subprocess
-        node_version = subprocess.check_output(['node', '--version'], stderr=subprocess.DEVNULL)
+        node_version = subprocess.check_output(['node', '--version'], stderr=subprocess.DEVNULL, timeout=10)
         if node_version:
             info['node_version'] = node_version.decode('utf-8').strip().lstrip('v')
             info['runtime'] = f"node{info['node_version']}"
@@ -47,10 +118,9 @@ def detect_runtime_info():
         pass
     
     try:
-        ruby_version = subprocess.check_output(['ruby', '--version'], stderr=subprocess.DEVNULL)
+        ruby_version = subprocess.check_output(['ruby', '--version'], stderr=subprocess.DEVNULL, timeout=10)
         if ruby_version:
             version_str = ruby_version.decode('utf-8')
-            import re
             match = re.search(r'ruby (\d+\.\d+\.\d+)', version_str)
             if match:
                 info['ruby_version'] = match.group(1)
@@ -59,7 +129,7 @@ def detect_runtime_info():
         pass
     
     try:
-        java_version = subprocess.check_output(['java', '-version'], stderr=subprocess.STDOUT)
+        java_version = subprocess.check_output(['java', '-version'], stderr=subprocess.STDOUT, timeout=10)
         if java_version:
             version_str = java_version.decode('utf-8')
             match = re.search(r'version "([^"]+)"', version_str)
@@ -76,8 +146,30 @@ def detect_runtime_info():
     
     return info
 
+class RuntimeInfo:
+    """Caches detect_runtime_info() so the node/ruby/java probes run once instead of per heartbeat"""
+    def __init__(self):
+        self.info = detect_runtime_info(probe_runtimes=False)
+        self.detected_at: Optional[float] = None
+        self.lock = threading.Lock()
+    
+    def refresh(self) -> Dict:
+        info = detect_runtime_info()
+        with self.lock:
+            self.info = info
+            self.detected_at = time.time()
+        return info
+    
+    def refresh_async(self):
+        threading.Thread(target=self.refresh, daemon=True, name='unitime-runtime').start()
+    
+    def get(self) -> Dict:
+        return self.info
+
+RUNTIME_INFO = RuntimeInfo()
+
 def build_user_agent(editor_name="unitime"):
-    runtime_info = detect_runtime_info()
+    runtime_info = RUNTIME_INFO.get()
     os_name = runtime_info.get('os_name', platform.system().lower())
     kernel_version = runtime_info.get('kernel_version', platform.release())
     runtime = runtime_info.get('runtime', f"python{platform.python_version()}")
@@ -85,33 +177,70 @@ def build_user_agent(editor_name="unitime"):
     return f"wakatime/v{PLUGIN_VERSION} ({os_name}-{kernel_version}) {runtime} {editor_name}/{PLUGIN_VERSION}"
 
 def build_plugin_name(editor_name="unitime"):
-    runtime_info = detect_runtime_info()
+    runtime_info = RUNTIME_INFO.get()
     os_name = runtime_info.get('os_name', platform.system().lower())
     kernel_version = runtime_info.get('kernel_version', platform.release())
     runtime = runtime_info.get('runtime', f"python{platform.python_version()}")
     
     return f"wakatime/v{PLUGIN_VERSION} ({os_name}-{kernel_version}) {runtime} {editor_name}/{PLUGIN_VERSION}"
 
-@dataclass
+HEARTBEAT_ENCODER = json.JSONEncoder(separators=(',', ':'))
+
 class Heartbeat:
-    entity: str
-    type: str = "file"
-    time: int = None
-    category: str = "coding"
-    project: str = None
-    branch: str = "main"
-    language: str = None
-    lineno: int = None
-    cursorpos: int = None
-    lines: int = None
-    is_write: bool = False
-    plugin: str = None
-
-    def __post_init__(self):
-        if self.time is None:
-            self.time = int(time.time())
-        if self.plugin is None:
-            self.plugin = build_plugin_name("unitime")
+    """A single heartbeat; to_wire() builds the API payload directly, leaving out unset optional fields"""
+    __slots__ = ('entity', 'type', 'time', 'category', 'project', 'branch', 'language', 'lineno', 'cursorpos',
+                 'lines', 'is_write', 'plugin', 'line_additions', 'line_deletions', 'entity_id')
+    _clock = staticmethod(time.time)
+    
+    def __init__(self, entity: Optional[str] = None, type: str = "file", time: Optional[int] = None,
+                 category: str = "coding", project: Optional[str] = None, branch: str = "main",
+                 language: Optional[str] = None, lineno: Optional[int] = None, cursorpos: Optional[int] = None,
+                 lines: Optional[int] = None, is_write: bool = False, plugin: Optional[str] = None,
+                 line_additions: Optional[int] = None, line_deletions: Optional[int] = None,
+                 entity_id: Optional[int] = None):
+        self.entity = entity
+        self.type = type
+        self.time = int(self._clock()) if time is None else time
+        self.category = category
+        self.project = project
+        self.branch = branch
+        self.language = language
+        self.lineno = lineno
+        self.cursorpos = cursorpos
+        self.lines = lines
+        self.is_write = is_write
+        self.plugin = build_plugin_name("unitime") if plugin is None else plugin
+        self.line_additions = line_additions
+        self.line_deletions = line_deletions
+        self.entity_id = entity_id
+    
+    def __repr__(self) -> str:
+        return f"Heartbeat(entity={self.entity!r}, entity_id={self.entity_id!r}, time={self.time!r}, is_write={self.is_write!r})"
+    
+    def to_wire(self, entity: Optional[str] = None) -> Dict:
+        data = {'entity': self.entity if entity is None else entity, 'type': self.type, 'time': self.time,
+                'category': self.category}
+        if self.project is not None:
+            data['project'] = self.project
+        data['branch'] = self.branch
+        if self.language is not None:
+            data['language'] = self.language
+        if self.lineno is not None:
+            data['lineno'] = self.lineno
+        if self.cursorpos is not None:
+            data['cursorpos'] = self.cursorpos
+        if self.lines is not None:
+            data['lines'] = self.lines
+        data['is_write'] = self.is_write
+        data['plugin'] = self.plugin
+        if self.line_additions is not None:
+            data['line_additions'] = self.line_additions
+        if self.line_deletions is not None:
+            data['line_deletions'] = self.line_deletions
+        return data
+    
+    def to_bytes(self, entity: Optional[str] = None) -> bytes:
+        return HEARTBEAT_ENCODER.encode(self.to_wire(entity)).encode('utf-8')
 
 class WakaTimeConfig:
     def __init__(self, wakatime_config_file: str = WAKATIME_CONFIG_FILE, tracker_config_file: str = TRACKER_CONFIG_FILE):
@@ -123,6 +252,16 @@ class WakaTimeConfig:
         self.heartbeat_interval = DEFAULT_HEARTBEAT_INTERVAL
         self.tracked_folders = []
         self.editor_name = "unitime"
+        self.hash_algorithm = "auto"
+        self.settle_window = DEFAULT_SETTLE_WINDOW
+        self.event_workers = DEFAULT_EVENT_WORKERS
+        self.event_queue_size = DEFAULT_EVENT_QUEUE_SIZE
+        self.memory_budget_mb = DEFAULT_MEMORY_BUDGET_MB
+        self.heartbeat_compaction = DEFAULT_COMPACTION
+        self.heartbeat_batch_size = DEFAULT_HEARTBEAT_BATCH_SIZE
+        self.compress_requests = False
+        self.outbox_max_entries = DEFAULT_OUTBOX_MAX_ENTRIES
+        self.outbox_max_age_days = DEFAULT_OUTBOX_MAX_AGE_DAYS
         self.load_config()
     
     def load_config(self):
@@ -205,6 +344,24 @@ class WakaTimeConfig:
         config.read(self.tracker_config_file)
         
         if 'tracker' in config:
+            self.hash_algorithm = config['tracker'].get('hash_algorithm', 'auto').strip().lower()
+            self.settle_window = self._read_number(config['tracker'], 'settle_window', DEFAULT_SETTLE_WINDOW, float, 0.0)
+            self.event_workers = self._read_number(config['tracker'], 'event_workers', DEFAULT_EVENT_WORKERS, int, 1)
+            self.event_queue_size = self._read_number(config['tracker'], 'event_queue_size', DEFAULT_EVENT_QUEUE_SIZE, int, 1)
+            self.memory_budget_mb = self._read_number(config['tracker'], 'memory_budget_mb', DEFAULT_MEMORY_BUDGET_MB, int, 8)
+            compaction = config['tracker'].get('heartbeat_compaction', DEFAULT_COMPACTION).strip().lower()
+            if compaction not in COMPACTION_MODES:
+                print(f"Invalid heartbeat_compaction in tracker config: {compaction}, using default: {DEFAULT_COMPACTION}")
+                compaction = DEFAULT_COMPACTION
+            self.heartbeat_compaction = compaction
+            self.heartbeat_batch_size = self._read_number(config['tracker'], 'heartbeat_batch_size', DEFAULT_HEARTBEAT_BATCH_SIZE, int, 1)
+            self.outbox_max_entries = self._read_number(config['tracker'], 'outbox_max_entries', DEFAULT_OUTBOX_MAX_ENTRIES, int, 100)
+            self.outbox_max_age_days = self._read_number(config['tracker'], 'outbox_max_age_days', DEFAULT_OUTBOX_MAX_AGE_DAYS, float, 1.0)
+            try:
+                self.compress_requests = config['tracker'].getboolean('compress_requests', False)
+            except ValueError:
+                print(f"Invalid compress_requests in tracker config: {config['tracker'].get('compress_requests')}, using default: False")
+                self.compress_requests = False
             tracked_folders_str = config['tracker'].get('tracked_folders', '')
             if tracked_folders_str:
                 self.tracked_folders = [
@@ -217,6 +374,17 @@ class WakaTimeConfig:
                 print("No tracked folders configured in tracker config")
                 self.tracked_folders = []
     
+    @staticmethod
+    def _read_number(section, key: str, default, cast, minimum):
+        value = section.get(key)
+        if not value:
+            return default
+        try:
+            return max(minimum, cast(value))
+        except ValueError:
+            print(f"Invalid {key} in tracker config: {value}, using default: {default}")
+            return default
+    
     def _create_default_tracker_config(self):
         config = configparser.ConfigParser()
         config.add_section('tracker')
@@ -232,17 +400,1879 @@ class WakaTimeConfig:
         except Exception as e:
             print(f"Failed to create tracker config file: {e}")
 
+def file_fingerprint(st: os.stat_result) -> Tuple[int, int, int]:
+    # SQLite integers are signed 64-bit, Windows file IDs can use the full 64 bits
+    return (st.st_size, st.st_mtime_ns, st.st_ino & 0x7FFFFFFFFFFFFFFF)
+
+LANGUAGE_BY_EXTENSION = MappingProxyType({
+    '.py': 'Python',
+    '.pyi': 'Python',
+    '.pyx': 'Cython',
+    '.pxd': 'Cython',
+    '.pyd': 'Python',
+    '.ipynb': 'Jupyter Notebook',
+    '.js': 'JavaScript',
+    '.jsx': 'React JSX',
+    '.ts': 'TypeScript',
+    '.tsx': 'React TSX',
+    '.vue': 'Vue',
+    '.svelte': 'Svelte',
+    '.html': 'HTML',
+    '.htm': 'HTML',
+    '.xhtml': 'XHTML',
+    '.css': 'CSS',
+    '.scss': 'SCSS',
+    '.sass': 'Sass',
+    '.less': 'Less',
+    '.php': 'PHP',
+    '.wasm': 'WebAssembly',
+    '.java': 'Java',
+    '.kt': 'Kotlin',
+    '.kts': 'Kotlin Script',
+    '.scala': 'Scala',
+    '.sc': 'Scala Script',
+    '.groovy': 'Groovy',
+    '.gvy': 'Groovy',
+    '.gradle': 'Gradle',
+    '.clj': 'Clojure',
+    '.cljs': 'ClojureScript',
+    '.cs': 'C#',
+    '.vb': 'Visual Basic',
+    '.fs': 'F#',
+    '.fsx': 'F# Script',
+    '.xaml': 'XAML',
+    '.c': 'C',
+    '.cpp': 'C++',
+    '.cc': 'C++',
+    '.cxx': 'C++',
+    '.cp': 'C++',
+    '.c++': 'C++',
+    '.h': 'C Header',
+    '.hpp': 'C++ Header',
+    '.hh': 'C++ Header',
+    '.hxx': 'C++ Header',
+    '.inl': 'C++ Inline',
+    '.cu': 'CUDA',
+    '.cuh': 'CUDA Header',
+    '.rs': 'Rust',
+    '.go': 'Go',
+    '.swift': 'Swift',
+    '.d': 'D',
+    '.zig': 'Zig',
+    '.nim': 'Nim',
+    '.cr': 'Crystal',
+    '.odin': 'Odin',
+    '.rb': 'Ruby',
+    '.erb': 'ERB',
+    '.rake': 'Ruby Rake',
+    '.pl': 'Perl',
+    '.pm': 'Perl Module',
+    '.t': 'Perl Test',
+    '.lua': 'Lua',
+    '.tcl': 'Tcl',
+    '.sh': 'Shell',
+    '.bash': 'Bash',
+    '.zsh': 'Zsh',
+    '.fish': 'Fish',
+    '.ps1': 'PowerShell',
+    '.psm1': 'PowerShell Module',
+    '.psd1': 'PowerShell Data',
+    '.bat': 'Batch',
+    '.cmd': 'Batch',
+    '.json': 'JSON',
+    '.yaml': 'YAML',
+    '.yml': 'YAML',
+    '.toml': 'TOML',
+    '.ini': 'INI',
+    '.xml': 'XML',
+    '.csv': 'CSV',
+    '.tsv': 'TSV',
+    '.sql': 'SQL',
+    '.graphql': 'GraphQL',
+    '.gql': 'GraphQL',
+    '.proto': 'Protocol Buffers',
+    '.avdl': 'Avro IDL',
+    '.thrift': 'Thrift',
+    '.hs': 'Haskell',
+    '.lhs': 'Literate Haskell',
+    '.ml': 'OCaml',
+    '.mli': 'OCaml Interface',
+    '.elm': 'Elm',
+    '.erl': 'Erlang',
+    '.ex': 'Elixir',
+    '.exs': 'Elixir Script',
+    '.gleam': 'Gleam',
+    '.lisp': 'Lisp',
+    '.cl': 'Common Lisp',
+    '.rkt': 'Racket',
+    '.r': 'R',
+    '.jl': 'Julia',
+    '.m': 'Objective-C',
+    '.mm': 'Objective-C++',
+    '.f': 'Fortran',
+    '.f90': 'Fortran 90',
+    '.f95': 'Fortran 95',
+    '.f03': 'Fortran 2003',
+    '.stan': 'Stan',
+    '.dart': 'Dart',
+    '.gd': 'GDScript',
+    '.hlsl': 'HLSL',
+    '.glsl': 'GLSL',
+    '.shader': 'Unity Shader',
+    '.as': 'ActionScript',
+    '.md': 'Markdown',
+    '.mdx': 'MDX',
+    '.rst': 'reStructuredText',
+    '.tex': 'LaTeX',
+    '.wiki': 'Wiki',
+    '.org': 'Org Mode',
+    '.adoc': 'AsciiDoc',
+    '.vim': 'Vim Script',
+    '.asm': 'Assembly',
+    '.s': 'Assembly',
+    '.nasm': 'NASM',
+    '.v': 'Verilog',
+    '.vhd': 'VHDL',
+    '.cmake': 'CMake',
+    '.make': 'Makefile',
+    '.nix': 'Nix',
+    '.awk': 'AWK',
+    '.ahk': 'AutoHotkey',
+    '.applescript': 'AppleScript',
+    '.bf': 'Brainfuck',
+    '.io': 'Io',
+    '.j': 'J',
+    '.hy': 'Hy',
+})
+
+LANGUAGE_BY_FILENAME = MappingProxyType({
+    'makefile': 'Makefile',
+    'gnumakefile': 'Makefile',
+    'dockerfile': 'Dockerfile',
+    'containerfile': 'Dockerfile',
+    'cmakelists.txt': 'CMake',
+    'rakefile': 'Ruby',
+    'gemfile': 'Ruby',
+    'vagrantfile': 'Ruby',
+    'podfile': 'Ruby',
+    'jenkinsfile': 'Groovy',
+    'build.bazel': 'Starlark',
+    'workspace.bazel': 'Starlark',
+    'justfile': 'Just',
+    'meson.build': 'Meson',
+})
+
+LANGUAGE_BY_INTERPRETER = MappingProxyType({
+    'python': 'Python',
+    'node': 'JavaScript',
+    'nodejs': 'JavaScript',
+    'deno': 'TypeScript',
+    'bun': 'JavaScript',
+    'sh': 'Shell',
+    'dash': 'Shell',
+    'bash': 'Bash',
+    'zsh': 'Zsh',
+    'fish': 'Fish',
+    'ruby': 'Ruby',
+    'perl': 'Perl',
+    'php': 'PHP',
+    'lua': 'Lua',
+    'rscript': 'R',
+    'julia': 'Julia',
+    'tclsh': 'Tcl',
+    'wish': 'Tcl',
+    'pwsh': 'PowerShell',
+    'elixir': 'Elixir',
+    'escript': 'Erlang',
+    'awk': 'AWK',
+    'gawk': 'AWK',
+    'make': 'Makefile',
+    'swift': 'Swift',
+    'groovy': 'Groovy',
+    'scala': 'Scala',
+    'kotlin': 'Kotlin Script',
+    'runghc': 'Haskell',
+    'stack': 'Haskell',
+    'nix-shell': 'Nix',
+})
+
+LANGUAGE_BY_MODELINE = MappingProxyType({
+    'python': 'Python',
+    'javascript': 'JavaScript',
+    'js': 'JavaScript',
+    'typescript': 'TypeScript',
+    'sh': 'Shell',
+    'shell-script': 'Shell',
+    'bash': 'Bash',
+    'zsh': 'Zsh',
+    'ruby': 'Ruby',
+    'perl': 'Perl',
+    'c': 'C',
+    'cpp': 'C++',
+    'c++': 'C++',
+    'make': 'Makefile',
+    'makefile': 'Makefile',
+    'cmake': 'CMake',
+    'yaml': 'YAML',
+    'json': 'JSON',
+    'lua': 'Lua',
+    'go': 'Go',
+    'rust': 'Rust',
+    'lisp': 'Lisp',
+    'emacs-lisp': 'Emacs Lisp',
+    'vim': 'Vim Script',
+    'dockerfile': 'Dockerfile',
+    'markdown': 'Markdown',
+    'conf': 'INI',
+    'dosini': 'INI',
+    'toml': 'TOML',
+})
+
+SHEBANG_PATTERN = re.compile(rb'^#!\s*(\S+)(?:[ \t]+(\S+))?')
+MODELINE_PATTERNS = (
+    re.compile(r'-\*-\s*(?:mode:\s*)?([\w+-]+)\s*(?:;.*)?-\*-', re.IGNORECASE),
+    re.compile(r'\b(?:vim?|ex):.*?\b(?:ft|filetype|syntax)=([\w+-]+)'),
+)
+CPP_HEADER_PATTERN = re.compile(r'^\s*(?:class|namespace|template\s*<)|std::|^\s*#include\s*<[a-z_]+>\s*$|\bpublic:|\bprivate:', re.MULTILINE)
+OBJC_PATTERN = re.compile(r'^\s*(?:@interface|@implementation|@protocol|@end|#import)\b', re.MULTILINE)
+MATLAB_PATTERN = re.compile(r'^\s*(?:function\b|end\s*$|%)|\];\s*$', re.MULTILINE)
+VERILOG_PATTERN = re.compile(r'^\s*(?:module|endmodule|always|wire|reg|input|output)\b', re.MULTILINE)
+COQ_PATTERN = re.compile(r'^\s*(?:Theorem|Lemma|Proof\.|Qed\.|Definition|Inductive|Require)\b', re.MULTILINE)
+VLANG_PATTERN = re.compile(r'^\s*(?:fn\s+\w+|module\s+\w+\s*$|import\s+\w+\s*$|struct\s+\w+\s*\{)', re.MULTILINE)
+PROLOG_PATTERN = re.compile(r':-|^\s*\w+\([^)]*\)\s*\.\s*$', re.MULTILINE)
+PERL_PATTERN = re.compile(r'^\s*(?:use\s+(?:strict|warnings)|my\s+[$@%]|sub\s+\w+|package\s+[\w:]+;)', re.MULTILINE)
+
+class LanguageClassifier:
+    """Maps files to languages from their name, extension and, for ambiguous files, their leading bytes"""
+    def __init__(self, cache_size: int = LANGUAGE_CACHE_SIZE):
+        self.cache_size = cache_size
+        self.cache: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.sniffers = {
+            '.h': self._sniff_header,
+            '.m': self._sniff_m,
+            '.v': self._sniff_v,
+            '.pl': self._sniff_pl,
+        }
+    
+    def classify(self, file_path: str, head: Optional[bytes] = None, inode: Optional[int] = None) -> Optional[str]:
+        name = os.path.basename(file_path)
+        lowered = name.lower()
+        language = LANGUAGE_BY_FILENAME.get(lowered)
+        if language is not None:
+            return language
+        if lowered.startswith('dockerfile.') or lowered.endswith('.dockerfile'):
+            return 'Dockerfile'
+        
+        ext = os.path.splitext(lowered)[1]
+        language = LANGUAGE_BY_EXTENSION.get(ext)
+        if language is not None and ext not in self.sniffers:
+            return language
+        
+        # Only ambiguous and unknown files need their content; cache those per (path, inode)
+        with self.lock:
+            cached = self.cache.get(file_path)
+            if cached is not None and inode is not None and cached[0] == inode:
+                self.cache.move_to_end(file_path)
+                return cached[1]
+        
+        if head is None:
+            try:
+                with open(file_path, 'rb') as f:
+                    head = f.read(SNIFF_SIZE)
+            except OSError:
+                return language
+        
+        sniffer = self.sniffers.get(ext)
+        if sniffer is not None:
+            language = sniffer(head.decode('utf-8', errors='ignore'))
+        else:
+            language = self._sniff_interpreter(head)
+        
+        if inode is not None:
+            with self.lock:
+                self.cache[file_path] = (inode, language)
+                self.cache.move_to_end(file_path)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return language
+    
+    def forget(self, file_path: str):
+        with self.lock:
+            self.cache.pop(file_path, None)
+    
+    @staticmethod
+    def _sniff_interpreter(head: bytes) -> Optional[str]:
+        match = SHEBANG_PATTERN.match(head)
+        if match:
+            interpreter = os.path.basename(match.group(1)).decode('utf-8', errors='ignore')
+            if interpreter == 'env' and match.group(2):
+                interpreter = match.group(2).decode('utf-8', errors='ignore')
+            interpreter = re.sub(r'[\d.]+$', '', interpreter).lower()
+            language = LANGUAGE_BY_INTERPRETER.get(interpreter)
+            if language is not None:
+                return language
+        text = head.decode('utf-8', errors='ignore')
+        lines = text.splitlines()
+        for line in lines[:5] + lines[-5:]:
+            for pattern in MODELINE_PATTERNS:
+                match = pattern.search(line)
+                if match:
+                    language = LANGUAGE_BY_MODELINE.get(match.group(1).lower())
+                    if language is not None:
+                        return language
+        return None
+    
+    @staticmethod
+    def _sniff_header(content: str) -> str:
+        if OBJC_PATTERN.search(content):
+            return 'Objective-C'
+        if CPP_HEADER_PATTERN.search(content):
+            return 'C++ Header'
+        return 'C Header'
+    
+    @staticmethod
+    def _sniff_m(content: str) -> str:
+        if OBJC_PATTERN.search(content):
+            return 'Objective-C'
+        if MATLAB_PATTERN.search(content):
+            return 'MATLAB'
+        return 'Objective-C'
+    
+    @staticmethod
+    def _sniff_v(content: str) -> str:
+        if COQ_PATTERN.search(content):
+            return 'Coq'
+        if VERILOG_PATTERN.search(content):
+            return 'Verilog'
+        if VLANG_PATTERN.search(content):
+            return 'V'
+        return 'Verilog'
+    
+    @staticmethod
+    def _sniff_pl(content: str) -> str:
+        if content.startswith('#!') or PERL_PATTERN.search(content):
+            return 'Perl'
+        if PROLOG_PATTERN.search(content):
+            return 'Prolog'
+        return 'Perl'
+
+LANGUAGE_CLASSIFIER = LanguageClassifier()
+
+@dataclass
+class FileInspection:
+    digest: int
+    lines: int
+    head: bytes
+    line_hashes: Optional[array] = None
+
+def diff_line_hashes(old: array, new: array) -> Tuple[int, int, int]:
+    """Return (first changed line, lines added, lines removed) after trimming the common prefix and suffix"""
+    limit = min(len(old), len(new))
+    prefix = 0
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old[-1 - suffix] == new[-1 - suffix]:
+        suffix += 1
+    return prefix + 1, len(new) - prefix - suffix, len(old) - prefix - suffix
+
+class FileHasher:
+    """Streams files through a reusable per-thread buffer into the fastest available digest"""
+    def __init__(self, algorithm: str = "auto"):
+        self.algorithm = self._resolve_algorithm(algorithm)
+        self._local = threading.local()
+    
+    @staticmethod
+    def _resolve_algorithm(algorithm: str) -> str:
+        algorithm = (algorithm or "auto").lower()
+        if algorithm not in ("auto", "xxhash", "blake2b", "md5"):
+            print(f"Unknown hash_algorithm '{algorithm}', using auto")
+            algorithm = "auto"
+        if algorithm in ("auto", "xxhash"):
+            if xxhash is not None:
+                return "xxhash"
+            if algorithm == "xxhash":
+                print("xxhash is not installed, falling back to blake2b")
+            algorithm = "blake2b"
+        if algorithm == "blake2b":
+            try:
+                hashlib.blake2b(digest_size=8)
+                return "blake2b"
+            except (AttributeError, ValueError):
+                print("blake2b is unavailable, falling back to md5")
+        return "md5"
+    
+    def new_digest(self):
+        if self.algorithm == "xxhash":
+            return xxhash.xxh3_64()
+        if self.algorithm == "blake2b":
+            return hashlib.blake2b(digest_size=8)
+        return hashlib.md5()
+    
+    @staticmethod
+    def digest_value(digest) -> int:
+        """Reduce a digest to the unsigned 64-bit integer kept in the digest table"""
+        return int.from_bytes(digest.digest()[:8], 'big')
+    
+    def _buffer(self) -> bytearray:
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None:
+            buffer = self._local.buffer = bytearray(HASH_CHUNK_SIZE)
+        return buffer
+    
+    def hash_file(self, file_path: str) -> int:
+        digest = self.new_digest()
+        buffer = self._buffer()
+        view = memoryview(buffer)
+        with open(file_path, 'rb', buffering=0) as f:
+            while True:
+                read = f.readinto(buffer)
+                if not read:
+                    break
+                digest.update(view[:read])
+        return self.digest_value(digest)
+    
+    def inspect_file(self, file_path: str, line_hashes: bool = False) -> FileInspection:
+        """Read file_path once for its digest, line count, leading bytes and optionally per-line hashes"""
+        digest = self.new_digest()
+        buffer = self._buffer()
+        view = memoryview(buffer)
+        head = b''
+        newlines = 0
+        last_byte = b'\n'
+        hashes = None
+        carry = b''
+        with open(file_path, 'rb', buffering=0) as f:
+            if line_hashes and os.fstat(f.fileno()).st_size <= LINE_SNAPSHOT_MAX_BYTES:
+                hashes = array('q')
+            while True:
+                read = f.readinto(buffer)
+                if not read:
+                    break
+                digest.update(view[:read])
+                newlines += buffer.count(b'\n', 0, read)
+                if len(head) < SNIFF_SIZE:
+                    head += bytes(view[:min(read, SNIFF_SIZE - len(head))])
+                last_byte = bytes(view[read - 1:read])
+                if hashes is not None:
+                    chunk_lines = (carry + bytes(view[:read])).split(b'\n')
+                    carry = chunk_lines.pop()
+                    hashes.extend(map(hash, chunk_lines))
+                    if len(hashes) * hashes.itemsize > LINE_SNAPSHOT_MAX_BYTES:
+                        # Pathologically short lines; not worth keeping a snapshot for
+                        hashes = None
+        if hashes is not None and carry:
+            hashes.append(hash(carry))
+        lines = newlines + (0 if last_byte == b'\n' else 1)
+        return FileInspection(digest=self.digest_value(digest), lines=lines, head=head, line_hashes=hashes)
+
+def _glob_to_regex(pattern: str) -> str:
+    regex = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith('**/', i):
+            regex.append('(?:.*/)?')
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            regex.append('.*')
+            i += 2
+            continue
+        if char == '*':
+            regex.append('[^/]*')
+        elif char == '?':
+            regex.append('[^/]')
+        elif char == '[':
+            end = pattern.find(']', i + 2)
+            if end == -1:
+                regex.append('\\[')
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                regex.append('[' + body.replace('\\', '\\\\') + ']')
+                i = end
+        elif char == '\\' and i + 1 < len(pattern):
+            i += 1
+            regex.append(re.escape(pattern[i]))
+        else:
+            regex.append(re.escape(char))
+        i += 1
+    return ''.join(regex)
+
+class IgnoreRules:
+    """Compiled gitignore-style patterns from the ignore files of a single directory"""
+    def __init__(self, lines: List[str]):
+        self.patterns = [pattern for pattern in map(self._compile, lines) if pattern is not None]
+    
+    @staticmethod
+    def _compile(line: str):
+        line = line.rstrip('\n').rstrip('\r')
+        if not line.strip() or line.startswith('#'):
+            return None
+        if not line.endswith('\\ '):
+            line = line.rstrip(' ')
+        negated = line.startswith('!')
+        if negated:
+            line = line[1:]
+        elif line.startswith('\\#') or line.startswith('\\!'):
+            line = line[1:]
+        dir_only = line.endswith('/')
+        line = line.rstrip('/')
+        if not line:
+            return None
+        anchored = '/' in line
+        line = line.lstrip('/')
+        prefix = '' if anchored else '(?:.*/)?'
+        return re.compile(prefix + _glob_to_regex(line) + '$'), negated, dir_only
+    
+    def match(self, relative_path: str, is_dir: bool) -> Optional[bool]:
+        """Return True if ignored, False if re-included by a negation, None if no pattern matches"""
+        for regex, negated, dir_only in reversed(self.patterns):
+            if dir_only and not is_dir:
+                continue
+            if regex.match(relative_path):
+                return not negated
+        return None
+
+class IgnoreEngine:
+    """Decides which paths under a tracked root are ignored, honoring nested ignore files"""
+    def __init__(self, root: str):
+        self.root = root
+        self.rules: Dict[str, Optional[IgnoreRules]] = {}
+    
+    def _rules_for(self, directory: str) -> Optional[IgnoreRules]:
+        try:
+            return self.rules[directory]
+        except KeyError:
+            pass
+        lines = []
+        for name in IGNORE_FILES:
+            try:
+                with open(os.path.join(directory, name), 'r', encoding='utf-8', errors='ignore') as f:
+                    lines.extend(f.readlines())
+            except OSError:
+                continue
+        rules = IgnoreRules(lines) if lines else None
+        self.rules[directory] = rules
+        return rules
+    
+    def invalidate(self, directory: str):
+        self.rules.pop(directory, None)
+    
+    def _match(self, parts: List[str], is_dir: bool) -> bool:
+        ignored = False
+        for depth in range(len(parts)):
+            rules = self._rules_for(os.path.join(self.root, *parts[:depth]))
+            if rules is not None:
+                result = rules.match('/'.join(parts[depth:]), is_dir)
+                if result is not None:
+                    ignored = result
+        return ignored
+    
+    def is_ignored(self, path: str, is_dir: bool = False, check_parents: bool = True) -> bool:
+        """check_parents=False assumes every ancestor below the root is already known not to be ignored"""
+        relative_path = os.path.relpath(path, self.root)
+        if relative_path == '.':
+            return False
+        parts = relative_path.split(os.sep)
+        if not check_parents:
+            return parts[-1].startswith('.') or self._match(parts, is_dir)
+        if any(part.startswith('.') for part in parts):
+            return True
+        for depth in range(1, len(parts)):
+            if self._match(parts[:depth], True):
+                return True
+        return self._match(parts, is_dir)
+
+class GitRepository:
+    """One git worktree with its HEAD resolved lazily and cached until invalidated"""
+    def __init__(self, worktree: str, git_dir: str, common_dir: str):
+        self.worktree = worktree
+        self.git_dir = git_dir
+        self.common_dir = common_dir
+        self._branch: Optional[str] = None
+    
+    @classmethod
+    def open(cls, worktree: str) -> Optional["GitRepository"]:
+        dot_git = os.path.join(worktree, '.git')
+        try:
+            if os.path.isdir(dot_git):
+                git_dir = dot_git
+            else:
+                # Worktrees and submodules use a .git file pointing at the real git dir
+                with open(dot_git, 'r') as f:
+                    content = f.read().strip()
+                if not content.startswith('gitdir:'):
+                    return None
+                git_dir = os.path.normpath(os.path.join(worktree, content[len('gitdir:'):].strip()))
+            common_dir = git_dir
+            commondir_file = os.path.join(git_dir, 'commondir')
+            if os.path.exists(commondir_file):
+                with open(commondir_file, 'r') as f:
+                    common_dir = os.path.normpath(os.path.join(git_dir, f.read().strip()))
+        except OSError:
+            return None
+        return cls(worktree, git_dir, common_dir)
+    
+    def branch(self) -> Optional[str]:
+        if self._branch is None:
+            self._branch = self._read_branch()
+        return self._branch
+    
+    def invalidate(self):
+        self._branch = None
+    
+    def _read_branch(self) -> Optional[str]:
+        try:
+            with open(os.path.join(self.git_dir, 'HEAD'), 'r') as f:
+                head = f.read().strip()
+        except OSError:
+            return None
+        if head.startswith('ref: '):
+            ref = head[len('ref: '):]
+            return ref[len('refs/heads/'):] if ref.startswith('refs/heads/') else ref
+        return self._branch_at_commit(head) or head[:7]
+    
+    def _branch_at_commit(self, commit: str) -> Optional[str]:
+        """Name a detached HEAD after a branch pointing at the same commit, if there is one"""
+        heads_dir = os.path.join(self.common_dir, 'refs', 'heads')
+        for dirpath, _, files in os.walk(heads_dir):
+            for name in files:
+                try:
+                    with open(os.path.join(dirpath, name), 'r') as f:
+                        if f.read().strip() == commit:
+                            return os.path.relpath(os.path.join(dirpath, name), heads_dir).replace(os.sep, '/')
+                except OSError:
+                    continue
+        try:
+            with open(os.path.join(self.common_dir, 'packed-refs'), 'r') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 2 and parts[0] == commit and parts[1].startswith('refs/heads/'):
+                        return parts[1][len('refs/heads/'):]
+        except OSError:
+            pass
+        return None
+
+class GitBranchResolver:
+    """Maps paths to their innermost git repository and serves cached branch names"""
+    def __init__(self):
+        self.repositories: Dict[str, GitRepository] = {}
+        self.directory_cache: Dict[str, Optional[str]] = {}
+        self.lock = threading.Lock()
+    
+    def discover(self, directory: str) -> Optional[GitRepository]:
+        """Register directory as a repository root if it contains .git; returns the repo only when newly added"""
+        if directory in self.repositories or not os.path.lexists(os.path.join(directory, '.git')):
+            return None
+        repository = GitRepository.open(directory)
+        if repository is None:
+            return None
+        with self.lock:
+            self.repositories[directory] = repository
+            # A nested repository changes the longest-prefix answer for cached directories
+            self.directory_cache.clear()
+        return repository
+    
+    def discover_ancestors(self, directory: str) -> List[GitRepository]:
+        discovered = []
+        while True:
+            repository = self.discover(directory)
+            if repository is not None:
+                discovered.append(repository)
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                return discovered
+            directory = parent
+    
+    def repository_for(self, file_path: str) -> Optional[GitRepository]:
+        directory = os.path.dirname(file_path)
+        try:
+            root = self.directory_cache[directory]
+        except KeyError:
+            root = directory
+            while root not in self.repositories:
+                parent = os.path.dirname(root)
+                if parent == root:
+                    root = None
+                    break
+                root = parent
+            self.directory_cache[directory] = root
+        return self.repositories.get(root) if root else None
+    
+    def branch_for(self, file_path: str) -> Optional[str]:
+        repository = self.repository_for(file_path)
+        return repository.branch() if repository else None
+    
+    def invalidate_git_dir(self, git_dir: str):
+        for repository in list(self.repositories.values()):
+            if repository.git_dir == git_dir or repository.common_dir == git_dir:
+                repository.invalidate()
+
+class ProjectResolver:
+    """Path-component trie over tracked roots that resolves a file to its most specific project"""
+    def __init__(self):
+        # Each node maps a path component to its child node; the None key marks a tracked root
+        self.trie: Dict = {}
+        self.override_cache: Dict[str, Optional[str]] = {}
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def _components(path: str) -> List[str]:
+        return [part for part in path.split(os.sep) if part]
+    
+    def add(self, root: str):
+        with self.lock:
+            node = self.trie
+            for part in self._components(root):
+                node = node.setdefault(part, {})
+            node[None] = root
+            self.override_cache.clear()
+    
+    def remove(self, root: str):
+        parts = self._components(root)
+        with self.lock:
+            nodes = [self.trie]
+            for part in parts:
+                child = nodes[-1].get(part)
+                if child is None:
+                    return
+                nodes.append(child)
+            nodes[-1].pop(None, None)
+            for depth in range(len(parts), 0, -1):
+                if nodes[depth]:
+                    break
+                del nodes[depth - 1][parts[depth - 1]]
+            self.override_cache.clear()
+    
+    def root_for(self, file_path: str) -> Optional[str]:
+        node = self.trie
+        root = node.get(None)
+        for part in self._components(file_path):
+            node = node.get(part)
+            if node is None:
+                break
+            root = node.get(None, root)
+        return root
+    
+    def _override_for(self, directory: str, root: str) -> Optional[str]:
+        try:
+            return self.override_cache[directory]
+        except KeyError:
+            pass
+        project = None
+        try:
+            with open(os.path.join(directory, PROJECT_FILE), 'r', encoding='utf-8', errors='ignore') as f:
+                project = f.readline().strip() or os.path.basename(directory)
+        except OSError:
+            parent = os.path.dirname(directory)
+            if directory != root and parent != directory:
+                project = self._override_for(parent, root)
+        self.override_cache[directory] = project
+        return project
+    
+    def invalidate_overrides(self):
+        self.override_cache.clear()
+    
+    def project_for(self, file_path: str) -> Optional[str]:
+        root = self.root_for(file_path)
+        if root is None:
+            return None
+        return self._override_for(os.path.dirname(file_path), root) or os.path.basename(root)
+
+class PathRegistry:
+    """Interns paths as (parent id, name) trie nodes held in packed arrays, so a file costs a few dozen bytes
+    instead of a str, a boxed int and a dict slot; names live in one bytearray and child lookup is an
+    open-addressing table keyed on (parent, name)"""
+    ROOT = 0
+    EMPTY = -1
+    MIN_SLOTS = 1024
+    # Compact the name buffer once dead names exceed this share of it
+    NAME_GARBAGE_RATIO = 0.5
+    DIRECTORY_CACHE_SIZE = 65536
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.parents = array('i', [self.EMPTY])
+        self.name_offsets = array('I', [0])
+        self.name_lengths = array('H', [0])
+        self.first_child = array('i', [self.EMPTY])
+        self.next_sibling = array('i', [self.EMPTY])
+        self.prev_sibling = array('i', [self.EMPTY])
+        self.name_bytes = bytearray()
+        self.garbage_bytes = 0
+        self.slots = array('i', [self.EMPTY]) * self.MIN_SLOTS
+        self.linked = 0
+        # Directory path -> node, so a lookup walks one name instead of every component
+        self.directories: Dict[str, int] = {}
+        # Detached nodes still resolve until reclaim() puts them on the free list for reuse
+        self.released = array('i')
+        self.free = array('i')
+    
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.parents) - 1 - len(self.released) - len(self.free)
+    
+    @staticmethod
+    def _encode(name: str) -> bytes:
+        return name.encode('utf-8', 'surrogateescape')
+    
+    def _name(self, node: int) -> bytes:
+        offset = self.name_offsets[node]
+        return bytes(self.name_bytes[offset:offset + self.name_lengths[node]])
+    
+    def _probe(self, parent: int, name: bytes) -> int:
+        """Slot holding (parent, name), or the empty slot it would go in"""
+        mask = len(self.slots) - 1
+        index = hash((parent, name)) & mask
+        while True:
+            node = self.slots[index]
+            if node == self.EMPTY or (self.parents[node] == parent and self.name_lengths[node] == len(name)
+                                      and self._name(node) == name):
+                return index
+            index = (index + 1) & mask
+    
+    def _directory(self, directory: str, create: bool) -> Optional[int]:
+        node = self.directories.get(directory)
+        if node is not None:
+            return node
+        node = self.ROOT
+        for name in directory.split(os.sep):
+            encoded = self._encode(name)
+            child = self.slots[self._probe(node, encoded)]
+            if child == self.EMPTY:
+                if not create:
+                    return None
+                child = self._new_node()
+                self._link(child, node, encoded)
+            node = child
+        # Only nodes with children are cached; see _detach and _prune for invalidation
+        if self.first_child[node] != self.EMPTY:
+            if len(self.directories) >= self.DIRECTORY_CACHE_SIZE:
+                self.directories.clear()
+            self.directories[directory] = node
+        return node
+    
+    def _find(self, file_path: str) -> Optional[int]:
+        directory, separator, name = file_path.rpartition(os.sep)
+        parent = self._directory(directory, False) if separator else self.ROOT
+        if parent is None:
+            return None
+        node = self.slots[self._probe(parent, self._encode(name))]
+        return None if node == self.EMPTY else node
+    
+    def _intern(self, file_path: str) -> int:
+        directory, separator, name = file_path.rpartition(os.sep)
+        parent = self._directory(directory, True) if separator else self.ROOT
+        encoded = self._encode(name)
+        node = self.slots[self._probe(parent, encoded)]
+        if node == self.EMPTY:
+            node = self._new_node()
+            self._link(node, parent, encoded)
+        return node
+    
+    def _new_node(self) -> int:
+        if self.free:
+            node = self.free.pop()
+        else:
+            node = len(self.parents)
+            for column in (self.parents, self.first_child, self.next_sibling, self.prev_sibling):
+                column.append(self.EMPTY)
+            self.name_offsets.append(0)
+            self.name_lengths.append(0)
+        self.first_child[node] = self.EMPTY
+        return node
+    
+    def _link(self, node: int, parent: int, name: bytes):
+        """Attach node under parent as name; its own children stay attached"""
+        if self.name_lengths[node]:
+            self.garbage_bytes += self.name_lengths[node]
+        self.parents[node] = parent
+        self.name_offsets[node] = len(self.name_bytes)
+        self.name_lengths[node] = len(name)
+        self.name_bytes += name
+        head = self.first_child[parent]
+        self.prev_sibling[node] = self.EMPTY
+        self.next_sibling[node] = head
+        if head != self.EMPTY:
+            self.prev_sibling[head] = node
+        self.first_child[parent] = node
+        self.slots[self._probe(parent, name)] = node
+        self.linked += 1
+        if self.linked * 3 > len(self.slots) * 2:
+            self._resize(len(self.slots) * 2)
+    
+    def _detach(self, node: int):
+        """Take node out of its parent's children and the lookup table"""
+        if self.first_child[node] != self.EMPTY:
+            self.directories.clear()
+        parent = self.parents[node]
+        previous, following = self.prev_sibling[node], self.next_sibling[node]
+        if previous == self.EMPTY:
+            self.first_child[parent] = following
+        else:
+            self.next_sibling[previous] = following
+        if following != self.EMPTY:
+            self.prev_sibling[following] = previous
+        self._unslot(parent, node)
+    
+    def _unslot(self, parent: int, node: int):
+        # Backward-shift deletion keeps linear probing chains unbroken without tombstones
+        mask = len(self.slots) - 1
+        hole = self._probe(parent, self._name(node))
+        self.slots[hole] = self.EMPTY
+        self.linked -= 1
+        index = hole
+        while True:
+            index = (index + 1) & mask
+            moved = self.slots[index]
+            if moved == self.EMPTY:
+                return
+            home = hash((self.parents[moved], self._name(moved))) & mask
+            if (index - home) & mask >= (index - hole) & mask:
+                self.slots[hole] = moved
+                self.slots[index] = self.EMPTY
+                hole = index
+    
+    def _resize(self, size: int):
+        self.slots = array('i', [self.EMPTY]) * size
+        mask = size - 1
+        stack = [self.ROOT]
+        while stack:
+            child = self.first_child[stack.pop()]
+            while child != self.EMPTY:
+                index = hash((self.parents[child], self._name(child))) & mask
+                while self.slots[index] != self.EMPTY:
+                    index = (index + 1) & mask
+                self.slots[index] = child
+                stack.append(child)
+                child = self.next_sibling[child]
+    
+    def _subtree(self, node: int) -> List[int]:
+        found = []
+        stack = [node]
+        while stack:
+            child = self.first_child[stack.pop()]
+            while child != self.EMPTY:
+                found.append(child)
+                stack.append(child)
+                child = self.next_sibling[child]
+        return found
+    
+    def _drop_subtree(self, node: int):
+        """Release an already detached node and everything below it"""
+        descendants = self._subtree(node)
+        for child in descendants:
+            self._unslot(self.parents[child], child)
+        self.released.append(node)
+        self.released.extend(descendants)
+    
+    def _prune(self, node: int):
+        """Release directories left without children, walking up from node"""
+        while node != self.ROOT and self.first_child[node] == self.EMPTY:
+            self.directories.clear()
+            parent = self.parents[node]
+            self._detach(node)
+            self.released.append(node)
+            node = parent
+    
+    def intern(self, file_path: str) -> int:
+        with self.lock:
+            return self._intern(file_path)
+    
+    def lookup(self, file_path: str) -> Optional[int]:
+        with self.lock:
+            return self._find(file_path)
+    
+    def path(self, node: int) -> str:
+        names = []
+        with self.lock:
+            while node != self.ROOT:
+                names.append(self._name(node).decode('utf-8', 'surrogateescape'))
+                node = self.parents[node]
+        return os.sep.join(reversed(names))
+    
+    def descendants(self, directory: str) -> List[int]:
+        with self.lock:
+            node = self._find(directory)
+            return [] if node is None else self._subtree(node)
+    
+    def move(self, src_path: str, dest_path: str) -> Optional[int]:
+        """Relink src (and everything below it) as dest so ids keyed off it stay valid"""
+        dest_parent, _, dest_name = dest_path.rpartition(os.sep)
+        with self.lock:
+            node = self._find(src_path)
+            if node is None:
+                return None
+            parent = self._directory(dest_parent, True)
+            name = self._encode(dest_name)
+            replaced = self.slots[self._probe(parent, name)]
+            if replaced == node:
+                return node
+            old_parent = self.parents[node]
+            self._detach(node)
+            if replaced != self.EMPTY:
+                self._detach(replaced)
+                self._drop_subtree(replaced)
+            self._link(node, parent, name)
+            # Only now, so a parent shared with the destination is not pruned in between
+            self._prune(old_parent)
+            return node
+    
+    def release(self, file_path: str) -> Optional[int]:
+        """Forget a path and its subtree; the ids keep resolving until they are reclaimed"""
+        with self.lock:
+            node = self._find(file_path)
+            if node is None:
+                return None
+            parent = self.parents[node]
+            self._detach(node)
+            self._drop_subtree(node)
+            self._prune(parent)
+            return node
+    
+    def take_released(self) -> array:
+        with self.lock:
+            released, self.released = self.released, array('i')
+            return released
+    
+    def reclaim(self, nodes: array):
+        """Make released ids reusable; only call once nothing queued still refers to them"""
+        with self.lock:
+            for node in nodes:
+                self.garbage_bytes += self.name_lengths[node]
+                self.name_lengths[node] = 0
+                self.parents[node] = self.EMPTY
+            self.free.extend(nodes)
+            if self.garbage_bytes > len(self.name_bytes) * self.NAME_GARBAGE_RATIO:
+                self._compact_names()
+    
+    def _compact_names(self):
+        names = bytearray()
+        for node in range(1, len(self.parents)):
+            length = self.name_lengths[node]
+            if length:
+                offset = self.name_offsets[node]
+                self.name_offsets[node] = len(names)
+                names += self.name_bytes[offset:offset + length]
+        self.name_bytes = names
+        self.garbage_bytes = 0
+    
+    def memory_bytes(self) -> int:
+        with self.lock:
+            cache = sys.getsizeof(self.directories) + sum(
+                sys.getsizeof(directory) + sys.getsizeof(node) for directory, node in self.directories.items())
+            return cache + sum(sys.getsizeof(column) for column in (
+                self.parents, self.name_offsets, self.name_lengths, self.first_child, self.next_sibling,
+                self.prev_sibling, self.name_bytes, self.slots, self.released, self.free))
+
+class DigestTable:
+    """Per-file state in parallel array columns (64-bit digest, size, mtime_ns, inode, last use) indexed by path id"""
+    def __init__(self):
+        self.digests = array('Q')
+        self.sizes = array('q')
+        self.mtimes = array('q')
+        self.inodes = array('q')
+        # Zero marks an empty row; the clock is bumped before every use so live rows never hold it
+        self.last_used = array('Q')
+        self.columns = (self.digests, self.sizes, self.mtimes, self.inodes, self.last_used)
+        self.count = 0
+        self.clock = 0
+    
+    def __len__(self) -> int:
+        return self.count
+    
+    def __contains__(self, path_id: int) -> bool:
+        return path_id < len(self.last_used) and self.last_used[path_id] != 0
+    
+    def get(self, path_id: int) -> Optional[Tuple[Tuple[int, int, int], int]]:
+        if path_id not in self:
+            return None
+        self.clock += 1
+        self.last_used[path_id] = self.clock
+        return (self.sizes[path_id], self.mtimes[path_id], self.inodes[path_id]), self.digests[path_id]
+    
+    def put(self, path_id: int, fingerprint: Tuple[int, int, int], digest: int):
+        missing = path_id + 1 - len(self.last_used)
+        if missing > 0:
+            # Path ids are dense, so growing every column to the id wastes little
+            for column in self.columns:
+                column.frombytes(bytes(missing * column.itemsize))
+        if not self.last_used[path_id]:
+            self.count += 1
+        self.clock += 1
+        self.digests[path_id] = digest
+        self.sizes[path_id], self.mtimes[path_id], self.inodes[path_id] = fingerprint
+        self.last_used[path_id] = self.clock
+    
+    def pop(self, path_id: int) -> bool:
+        if path_id not in self:
+            return False
+        self.last_used[path_id] = 0
+        self.count -= 1
+        return True
+    
+    def evict_coldest(self, count: int) -> List[int]:
+        occupied = itertools.compress(range(len(self.last_used)), self.last_used)
+        evicted = heapq.nsmallest(count, occupied, key=self.last_used.__getitem__)
+        for path_id in evicted:
+            self.pop(path_id)
+        return evicted
+    
+    def memory_bytes(self) -> int:
+        return sum(sys.getsizeof(column) for column in self.columns)
+
+class FingerprintIndex:
+    """Persistent path -> (size, mtime_ns, inode, digest) index shared across restarts"""
+    SCHEMA = "digest64"
+    
+    def __init__(self, db_path: str = FILE_INDEX_FILE, algorithm: str = "md5"):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = None
+        try:
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+            self.conn = sqlite3.connect(db_path, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS files ('
+                'path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, '
+                'inode INTEGER NOT NULL, digest INTEGER NOT NULL)'
+            )
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            # Digests from another algorithm or an older digest format can never match, so start over
+            layout = f"{algorithm}/{self.SCHEMA}"
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'algorithm'").fetchone()
+            if row is None or row[0] != layout:
+                self.conn.execute('DELETE FROM files')
+                self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('algorithm', ?)", (layout,))
+            self.conn.commit()
+        except (OSError, sqlite3.Error) as e:
+            print(f"Warning: File index unavailable at {db_path}, falling back to memory only: {e}")
+            self.conn = None
+    
+    @staticmethod
+    def _to_db(digest: int) -> int:
+        # SQLite integers are signed 64-bit
+        return digest - (1 << 64) if digest >= (1 << 63) else digest
+    
+    @staticmethod
+    def _from_db(value: int) -> int:
+        return value & 0xFFFFFFFFFFFFFFFF
+    
+    @staticmethod
+    def _prefix_range(directory: str) -> Tuple[str, str]:
+        prefix = directory.rstrip(os.sep) + os.sep
+        return prefix, prefix[:-1] + chr(ord(os.sep) + 1)
+    
+    def load_directory(self, directory: str) -> Dict[str, Tuple[int, int, int, int]]:
+        if self.conn is None:
+            return {}
+        low, high = self._prefix_range(directory)
+        try:
+            with self.lock:
+                rows = self.conn.execute(
+                    'SELECT path, size, mtime_ns, inode, digest FROM files WHERE path >= ? AND path < ?',
+                    (low, high)
+                ).fetchall()
+        except sqlite3.Error as e:
+            print(f"DEBUG: Error loading file index for {directory}: {e}")
+            return {}
+        return {path: (size, mtime_ns, inode, self._from_db(digest)) for path, size, mtime_ns, inode, digest in rows}
+    
+    def put_many(self, rows: List[Tuple[str, int, int, int, int]]):
+        if self.conn is None or not rows:
+            return
+        rows = [(path, size, mtime_ns, inode, self._to_db(digest)) for path, size, mtime_ns, inode, digest in rows]
+        try:
+            with self.lock:
+                self.conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)', rows)
+                self.conn.commit()
+        except sqlite3.Error as e:
+            print(f"DEBUG: Error writing file index: {e}")
+    
+    def put(self, file_path: str, fingerprint: Tuple[int, int, int], digest: int):
+        self.put_many([(file_path, *fingerprint, digest)])
+    
+    def get(self, file_path: str) -> Optional[Tuple[int, int, int, int]]:
+        if self.conn is None:
+            return None
+        try:
+            with self.lock:
+                row = self.conn.execute(
+                    'SELECT size, mtime_ns, inode, digest FROM files WHERE path = ?', (file_path,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            print(f"DEBUG: Error reading file index: {e}")
+            return None
+        if row is None:
+            return None
+        size, mtime_ns, inode, digest = row
+        return size, mtime_ns, inode, self._from_db(digest)
+    
+    def remove(self, file_path: str) -> bool:
+        if self.conn is None:
+            return False
+        try:
+            with self.lock:
+                removed = self.conn.execute('DELETE FROM files WHERE path = ?', (file_path,)).rowcount
+                self.conn.commit()
+        except sqlite3.Error as e:
+            print(f"DEBUG: Error writing file index: {e}")
+            return False
+        return removed > 0
+    
+    def count_tree(self, directory: str) -> int:
+        if self.conn is None:
+            return 0
+        low, high = self._prefix_range(directory)
+        try:
+            with self.lock:
+                return self.conn.execute('SELECT COUNT(*) FROM files WHERE path >= ? AND path < ?',
+                                         (low, high)).fetchone()[0]
+        except sqlite3.Error as e:
+            print(f"DEBUG: Error reading file index: {e}")
+            return 0
+    
+    def remove_tree(self, directory: str) -> int:
+        if self.conn is None:
+            return 0
+        low, high = self._prefix_range(directory)
+        try:
+            with self.lock:
+                removed = self.conn.execute('DELETE FROM files WHERE path >= ? AND path < ?', (low, high)).rowcount
+                self.conn.commit()
+        except sqlite3.Error as e:
+            print(f"DEBUG: Error writing file index: {e}")
+            return 0
+        return removed
+    
+    def move(self, src_path: str, dest_path: str):
+        if self.conn is None:
+            return
+        low, high = self._prefix_range(src_path)
+        try:
+            with self.lock:
+                self.conn.execute('DELETE FROM files WHERE path = ? OR (path >= ? AND path < ?)',
+                                  (dest_path,) + self._prefix_range(dest_path))
+                self.conn.execute('UPDATE files SET path = ? WHERE path = ?', (dest_path, src_path))
+                self.conn.execute(
+                    'UPDATE files SET path = ? || substr(path, ?) WHERE path >= ? AND path < ?',
+                    (dest_path, len(src_path) + 1, low, high)
+                )
+                self.conn.commit()
+        except sqlite3.Error as e:
+            print(f"DEBUG: Error writing file index: {e}")
+    
+    def remove_missing(self, directory: str, present: Set[str]):
+        if self.conn is None:
+            return
+        stale = [(path,) for path in self.load_directory(directory) if path not in present]
+        if not stale:
+            return
+        try:
+            with self.lock:
+                self.conn.executemany('DELETE FROM files WHERE path = ?', stale)
+                self.conn.commit()
+        except sqlite3.Error as e:
+            print(f"DEBUG: Error pruning file index: {e}")
+    
+    def close(self):
+        if self.conn is not None:
+            with self.lock:
+                self.conn.close()
+                self.conn = None
+
+class HeartbeatOutbox:
+    """Durable queue of serialized heartbeats, drained oldest first and deleted only once the server has them"""
+    def __init__(self, db_path: str = OUTBOX_FILE, max_entries: int = DEFAULT_OUTBOX_MAX_ENTRIES,
+                 max_age_days: float = DEFAULT_OUTBOX_MAX_AGE_DAYS):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 86400
+        self.lock = threading.Lock()
+        self.conn = None
+        # Rows that could not be written to the database, either because it cannot be opened or because a
+        # write failed; they get negative ids so they never collide with database rows
+        self.memory: List[Tuple[int, float, bytes]] = []
+        self.next_id = -1
+        self.count = 0
+        self.stats = {'stored': 0, 'acknowledged': 0, 'rejected': 0, 'expired': 0}
+        try:
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+            self.conn = sqlite3.connect(db_path, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            # Each flush is one transaction, so FULL costs one fsync per flush
+            self.conn.execute('PRAGMA synchronous=FULL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS heartbeats ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, time REAL NOT NULL, payload BLOB NOT NULL)'
+            )
+            self.conn.execute('CREATE INDEX IF NOT EXISTS heartbeats_time ON heartbeats (time, id)')
+            self.conn.commit()
+            self.count = self.conn.execute('SELECT COUNT(*) FROM heartbeats').fetchone()[0]
+        except (OSError, sqlite3.Error) as e:
+            print(f"Warning: Heartbeat outbox unavailable at {db_path}, keeping heartbeats in memory only: {e}")
+            self.conn = None
+        if self.count:
+            print(f"Found {self.count} unsent heartbeat(s) from a previous session")
+    
+    def __len__(self) -> int:
+        return self.count
+    
+    def _keep_in_memory(self, rows: List[Tuple[float, bytes]]):
+        for sent_at, payload in rows:
+            self.memory.append((self.next_id, sent_at, payload))
+            self.next_id -= 1
+    
+    def _write(self, rows: List[Tuple[float, bytes]]) -> bool:
+        """Insert rows, along with anything spilled to memory earlier, in one transaction (caller holds self.lock)"""
+        if self.conn is None:
+            return False
+        spilled = [(sent_at, payload) for _, sent_at, payload in self.memory]
+        try:
+            self.conn.executemany('INSERT INTO heartbeats (time, payload) VALUES (?, ?)', spilled + rows)
+            self.conn.commit()
+        except sqlite3.Error as e:
+            print(f"DEBUG: Error writing heartbeat outbox, keeping heartbeats in memory: {e}")
+            try:
+                self.conn.rollback()
+            except sqlite3.Error:
+                pass
+            return False
+        self.memory = []
+        return True
+    
+    def put_many(self, rows: List[Tuple[float, bytes]]):
+        if not rows:
+            return
+        with self.lock:
+            if not self._write(rows):
+                self._keep_in_memory(rows)
+            self.count += len(rows)
+            self.stats['stored'] += len(rows)
+        self.prune()
+    
+    def peek(self, limit: int) -> List[Tuple[int, bytes]]:
+        with self.lock:
+            rows = []
+            if self.conn is not None:
+                try:
+                    rows = self.conn.execute(
+                        'SELECT id, time, payload FROM heartbeats ORDER BY time, id LIMIT ?', (limit,)
+                    ).fetchall()
+                except sqlite3.Error as e:
+                    print(f"DEBUG: Error reading heartbeat outbox: {e}")
+            if self.memory:
+                rows = sorted(rows + self.memory, key=lambda row: (row[1], abs(row[0])))[:limit]
+            return [(row_id, payload) for row_id, _, payload in rows]
+    
+    def acknowledge(self, acknowledged: List[int], rejected: List[int]):
+        """Delete heartbeats the server accepted or permanently refused"""
+        ids = acknowledged + rejected
+        if not ids:
+            return
+        with self.lock:
+            removed = 0
+            stored = [(row_id,) for row_id in ids if row_id > 0]
+            if stored and self.conn is not None:
+                try:
+                    removed = self.conn.executemany('DELETE FROM heartbeats WHERE id = ?', stored).rowcount
+                    self.conn.commit()
+                except sqlite3.Error as e:
+                    print(f"DEBUG: Error writing heartbeat outbox: {e}")
+                    return
+            if len(stored) < len(ids):
+                done = set(ids)
+                remaining = [row for row in self.memory if row[0] not in done]
+                removed += len(self.memory) - len(remaining)
+                self.memory = remaining
+            self.count = max(0, self.count - removed)
+            self.stats['acknowledged'] += len(acknowledged)
+            self.stats['rejected'] += len(rejected)
+    
+    def prune(self) -> int:
+        """Drop heartbeats past the age limit, then the oldest ones beyond the size limit"""
+        cutoff = time.time() - self.max_age
+        with self.lock:
+            expired = 0
+            if self.memory:
+                kept = [row for row in self.memory if row[1] >= cutoff]
+                kept.sort(key=lambda row: (row[1], abs(row[0])))
+                kept = kept[-self.max_entries:]
+                expired = len(self.memory) - len(kept)
+                self.memory = kept
+            if self.conn is not None:
+                try:
+                    expired += self.conn.execute('DELETE FROM heartbeats WHERE time < ?', (cutoff,)).rowcount
+                    if self.count - expired > self.max_entries:
+                        expired += self.conn.execute(
+                            'DELETE FROM heartbeats WHERE id IN '
+                            '(SELECT id FROM heartbeats ORDER BY time DESC, id DESC LIMIT -1 OFFSET ?)',
+                            (max(0, self.max_entries - len(self.memory)),)
+                        ).rowcount
+                    self.conn.commit()
+                except sqlite3.Error as e:
+                    print(f"DEBUG: Error pruning heartbeat outbox: {e}")
+            if expired:
+                print(f"DEBUG: Dropped {expired} heartbeat(s) past the outbox age or size limit")
+            self.count = max(0, self.count - expired)
+            self.stats['expired'] += expired
+        return expired
+    
+    def get_stats(self) -> Dict:
+        with self.lock:
+            oldest = min((row[1] for row in self.memory), default=None)
+            if self.conn is not None and self.count > len(self.memory):
+                try:
+                    stored = self.conn.execute('SELECT MIN(time) FROM heartbeats').fetchone()[0]
+                    if stored is not None:
+                        oldest = stored if oldest is None else min(oldest, stored)
+                except sqlite3.Error:
+                    pass
+            return dict(self.stats, pending=self.count, durable=self.conn is not None and not self.memory,
+                        oldest_age=round(time.time() - oldest, 1) if oldest is not None else None)
+    
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                if self.memory:
+                    # Last chance to make heartbeats spilled to memory survive the restart
+                    self._write([])
+                self.conn.close()
+                self.conn = None
+
+def is_accepted(status: Optional[int]) -> bool:
+    return status is not None and 200 <= status < 300
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header, which is either a delay or an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+class SendPolicy:
+    """Backoff with jitter plus a circuit breaker that lets a single probe through once the cool-down ends"""
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    
+    def __init__(self, base_delay: float = BACKOFF_BASE_SECONDS, max_delay: float = BACKOFF_MAX_SECONDS,
+                 failure_threshold: int = BREAKER_FAILURE_THRESHOLD):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.next_attempt = 0.0
+        self.stats = {'successes': 0, 'failures': 0, 'deferred': 0, 'opened': 0}
+    
+    def allow(self) -> bool:
+        with self.lock:
+            if time.monotonic() < self.next_attempt:
+                self.stats['deferred'] += 1
+                return False
+            if self.state == self.OPEN:
+                self.state = self.HALF_OPEN
+            return True
+    
+    def probing(self) -> bool:
+        with self.lock:
+            return self.state == self.HALF_OPEN
+    
+    def retry_in(self) -> float:
+        with self.lock:
+            return max(0.0, self.next_attempt - time.monotonic())
+    
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                print("DEBUG: Heartbeat API reachable again, closing circuit breaker")
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self.next_attempt = 0.0
+            self.stats['successes'] += 1
+    
+    def record_failure(self, retry_after: Optional[float] = None):
+        with self.lock:
+            self.consecutive_failures += 1
+            self.stats['failures'] += 1
+            delay = min(self.max_delay, self.base_delay * (2 ** min(self.consecutive_failures - 1, 30)))
+            # Equal jitter keeps clients that failed together from retrying together
+            delay = delay / 2 + random.uniform(0, delay / 2)
+            if retry_after is not None:
+                delay = max(delay, min(retry_after, self.max_delay))
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.stats['opened'] += 1
+                    print(f"DEBUG: Opening circuit breaker after {self.consecutive_failures} failed send(s)")
+                self.state = self.OPEN
+            self.next_attempt = time.monotonic() + delay
+    
+    def reset(self):
+        """Forget past failures, e.g. once the API key or URL that caused them has been changed"""
+        with self.lock:
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self.next_attempt = 0.0
+    
+    def get_stats(self) -> Dict:
+        with self.lock:
+            return dict(self.stats, state=self.state, consecutive_failures=self.consecutive_failures,
+                        retry_in=round(max(0.0, self.next_attempt - time.monotonic()), 1))
+
+class SettleScheduler:
+    """Coalesces events per path and dispatches each path once after it has been quiet for the settle window,
+    or at most SETTLE_MAX_DELAY_FACTOR windows after its first event"""
+    def __init__(self, callback, settle_window: float = DEFAULT_SETTLE_WINDOW,
+                 max_pending: int = DEFAULT_EVENT_QUEUE_SIZE):
+        self.callback = callback
+        self.settle_window = settle_window
+        self.max_delay = settle_window * SETTLE_MAX_DELAY_FACTOR
+        self.max_pending = max_pending
+        self.pending: OrderedDict = OrderedDict()
+        self.heap: List[Tuple[float, int, str]] = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.running = True
+        self.stats = {'scheduled': 0, 'coalesced': 0, 'dropped': 0, 'dispatched': 0}
+        self.thread = threading.Thread(target=self._run, daemon=True, name='unitime-settle')
+        self.thread.start()
+    
+    def schedule(self, file_path: str, is_write: bool = False):
+        now = time.monotonic()
+        deadline = now + self.settle_window
+        with self.condition:
+            entry = self.pending.get(file_path)
+            if entry is not None:
+                # The heap entry keeps its old deadline; _run re-queues it when it surfaces early
+                entry[0] = min(deadline, entry[2] + self.max_delay)
+                entry[1] = entry[1] or is_write
+                self.stats['coalesced'] += 1
+                return
+            if len(self.pending) >= self.max_pending:
+                # Drop the oldest pending path; its heap entry is skipped when it surfaces
+                dropped_path, _ = self.pending.popitem(last=False)
+                self.stats['dropped'] += 1
+                print(f"DEBUG: Event backlog full, dropping pending change for {dropped_path}")
+            self.pending[file_path] = [deadline, is_write, now]
+            heapq.heappush(self.heap, (deadline, next(self.sequence), file_path))
+            self.stats['scheduled'] += 1
+            self.condition.notify()
+    
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.heap:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                deadline, _, file_path = self.heap[0]
+                now = time.monotonic()
+                if deadline > now:
+                    self.condition.wait(deadline - now)
+                    continue
+                heapq.heappop(self.heap)
+                entry = self.pending.get(file_path)
+                if entry is None:
+                    continue
+                if entry[0] > now:
+                    heapq.heappush(self.heap, (entry[0], next(self.sequence), file_path))
+                    continue
+                del self.pending[file_path]
+                self.stats['dispatched'] += 1
+            
+            try:
+                self.callback(file_path, entry[1])
+            except Exception as e:
+                print(f"Error processing file change {file_path}: {e}")
+    
+    def get_stats(self) -> Dict:
+        with self.condition:
+            return dict(self.stats, pending=len(self.pending), settle_window=self.settle_window)
+    
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+
+class EventPipeline:
+    """Bounded, path-coalescing work queue drained by a pool of worker threads"""
+    def __init__(self, process, workers: int = DEFAULT_EVENT_WORKERS, capacity: int = DEFAULT_EVENT_QUEUE_SIZE):
+        self.process = process
+        self.capacity = capacity
+        self.queue: OrderedDict = OrderedDict()
+        # Deletes, moves and new directories: never dropped, run one at a time in arrival order
+        self.ordered: deque = deque()
+        self.ordered_busy = False
+        self.in_flight: Set[str] = set()
+        self.condition = threading.Condition()
+        self.running = True
+        self.stats = {'enqueued': 0, 'coalesced': 0, 'dropped': 0, 'processed': 0, 'errors': 0}
+        self.workers = [
+            threading.Thread(target=self._run, daemon=True, name=f'unitime-event-{i}')
+            for i in range(workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+    
+    def put(self, file_path: str, is_write: bool = False):
+        with self.condition:
+            if file_path in self.queue:
+                self.queue[file_path] = self.queue[file_path] or is_write
+                self.stats['coalesced'] += 1
+                return
+            if len(self.queue) >= self.capacity:
+                dropped_path, _ = self.queue.popitem(last=False)
+                self.stats['dropped'] += 1
+                print(f"DEBUG: Event queue full, dropping queued change for {dropped_path}")
+            self.queue[file_path] = is_write
+            self.stats['enqueued'] += 1
+            self.condition.notify()
+    
+    def submit(self, key: str, task):
+        """Queue a structural change behind any earlier ones; key is the path it touches"""
+        with self.condition:
+            self.ordered.append((key, task))
+            self.stats['enqueued'] += 1
+            self.condition.notify()
+    
+    def _take(self) -> Optional[Tuple[str, bool, Optional[object]]]:
+        # Never hand the same path to two workers at once
+        if self.ordered and not self.ordered_busy and self.ordered[0][0] not in self.in_flight:
+            key, task = self.ordered.popleft()
+            self.ordered_busy = True
+            self.in_flight.add(key)
+            return key, False, task
+        for file_path in self.queue:
+            if file_path not in self.in_flight:
+                self.in_flight.add(file_path)
+                return file_path, self.queue.pop(file_path), None
+        return None
+    
+    def _run(self):
+        while True:
+            with self.condition:
+                item = self._take()
+                while self.running and item is None:
+                    self.condition.wait()
+                    item = self._take()
+                if not self.running:
+                    return
+            
+            file_path, is_write, task = item
+            try:
+                if task is None:
+                    self.process(file_path, is_write)
+                else:
+                    task()
+                outcome = 'processed'
+            except Exception as e:
+                print(f"Error processing file change {file_path}: {e}")
+                outcome = 'errors'
+            
+            with self.condition:
+                self.in_flight.discard(file_path)
+                if task is not None:
+                    self.ordered_busy = False
+                self.stats[outcome] += 1
+                if self.queue or self.ordered:
+                    self.condition.notify_all()
+    
+    def get_stats(self) -> Dict:
+        with self.condition:
+            return dict(self.stats, queued=len(self.queue), ordered=len(self.ordered), in_flight=len(self.in_flight),
+                        workers=len(self.workers), capacity=self.capacity)
+    
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join()
+
+class DirectoryWatcher(FileSystemEventHandler):
+    """Watches one tracked root through a single inotify instance holding a watch per non-ignored directory.
+    Without inotify it falls back to one recursive observer watch and drops events from unwatched directories"""
+    def __init__(self, root: str, handler: FileSystemEventHandler):
+        self.root = root
+        self.handler = handler
+        # Watched directory -> handler for events inside it
+        self.directories: Dict[str, FileSystemEventHandler] = {}
+        self.lock = threading.Lock()
+        self.observer: Optional[Observer] = None
+        self.external_watches: Dict[str, ObservedWatch] = {}
+        self.directories[root] = handler
+        self.inotify = None
+        if InotifyBuffer is not None:
+            try:
+                self.inotify = InotifyBuffer(os.fsencode(root))
+            except (TypeError, AttributeError) as e:
+                print(f"DEBUG: watchdog's inotify buffer is unusable ({e}), watching {root} recursively")
+        if self.inotify is not None:
+            self.thread = threading.Thread(target=self._read_events, daemon=True, name='unitime-watch')
+            self.thread.start()
+        else:
+            self._start_observer()
+    
+    def _start_observer(self):
+        self.observer = Observer()
+        self.observer.schedule(self, self.root, recursive=True)
+        self.observer.start()
+    
+    def _fall_back_to_observer(self):
+        """Swap the inotify buffer for a recursive observer watch, keeping the directories added so far"""
+        inotify, self.inotify = self.inotify, None
+        inotify.close()
+        self._start_observer()
+        for directory in self.directories:
+            self._watch_external(directory)
+    
+    def _watch_external(self, directory: str):
+        # The recursive watch on the root already covers everything below it
+        if directory != self.root and not directory.startswith(self.root.rstrip(os.sep) + os.sep):
+            self.external_watches[directory] = self.observer.schedule(self, directory, recursive=False)
+    
+    def add(self, directory: str, handler: Optional[FileSystemEventHandler] = None) -> bool:
+        with self.lock:
+            if directory in self.directories:
+                return False
+            if self.inotify is not None:
+                try:
+                    # Re-adding a moved directory returns its existing watch, now mapped to the new path
+                    self.inotify._inotify.add_watch(os.fsencode(directory))
+                except AttributeError as e:
+                    # InotifyBuffer._inotify is watchdog-internal; if it moves, keep watching the slower way
+                    print(f"DEBUG: watchdog's inotify internals changed ({e}), watching {self.root} recursively")
+                    self._fall_back_to_observer()
+            if self.inotify is None:
+                self._watch_external(directory)
+            self.directories[directory] = handler or self.handler
+            return True
+    
+    def remove_tree(self, directory: str):
+        """Stop dispatching events from directory and everything below it"""
+        prefix = directory.rstrip(os.sep) + os.sep
+        with self.lock:
+            for path in [path for path in self.directories
+                         if path != self.root and (path == directory or path.startswith(prefix))]:
+                del self.directories[path]
+                watch = self.external_watches.pop(path, None)
+                if watch is not None:
+                    self.observer.unschedule(watch)
+        # inotify drops the kernel watches of deleted directories itself, and a moved directory keeps its
+        # watches for the new path to reuse; removing them here would race the IN_IGNORED bookkeeping
+    
+    def _read_events(self):
+        while True:
+            event = self.inotify.read_event()
+            if event is None:
+                return
+            event = self._convert(event)
+            if event is not None:
+                self.dispatch(event)
+    
+    @staticmethod
+    def _convert(event):
+        if isinstance(event, tuple):
+            move_from, move_to = event
+            cls = DirMovedEvent if move_from.is_directory else FileMovedEvent
+            return cls(os.fsdecode(move_from.src_path), os.fsdecode(move_to.src_path))
+        src_path = os.fsdecode(event.src_path)
+        if event.is_create or event.is_moved_to:
+            return (DirCreatedEvent if event.is_directory else FileCreatedEvent)(src_path)
+        if event.is_delete or event.is_moved_from:
+            return (DirDeletedEvent if event.is_directory else FileDeletedEvent)(src_path)
+        if (event.is_modify or event.is_attrib) and not event.is_directory:
+            return FileModifiedEvent(src_path)
+        return None
+    
+    def dispatch(self, event):
+        src_handler = self.directories.get(os.path.dirname(event.src_path))
+        if event.event_type == 'moved':
+            dest_handler = self.directories.get(os.path.dirname(event.dest_path))
+            # A move across the edge of the watched tree is a create or delete from its point of view
+            if src_handler is None and dest_handler is not None:
+                cls = DirCreatedEvent if event.is_directory else FileCreatedEvent
+                event, src_handler = cls(event.dest_path), dest_handler
+            elif dest_handler is None and src_handler is not None:
+                event = (DirDeletedEvent if event.is_directory else FileDeletedEvent)(event.src_path)
+        if src_handler is None:
+            return
+        try:
+            src_handler.dispatch(event)
+        except Exception as e:
+            print(f"Error handling file system event {event.src_path}: {e}")
+    
+    def stop(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.thread.join()
+        else:
+            self.observer.stop()
+            self.observer.join()
+
 class FileTracker:
     def __init__(self, config: WakaTimeConfig):
         self.config = config
-        self.file_hashes: Dict[str, str] = {}
-        self.last_heartbeat: Dict[str, float] = {}
+        self.hasher = FileHasher(config.hash_algorithm)
+        self.fingerprint_index = FingerprintIndex(algorithm=self.hasher.algorithm)
+        self.outbox = HeartbeatOutbox(max_entries=config.outbox_max_entries, max_age_days=config.outbox_max_age_days)
+        budget = config.memory_budget_mb * 1024 * 1024
+        # Three quarters of the budget for per-file state, the rest for line-hash snapshots
+        self.max_file_entries = max(1024, (budget * 3 // 4) // FILE_STATE_ENTRY_BYTES)
+        self.line_snapshot_budget = budget // 4
+        self.path_registry = PathRegistry()
+        self.file_table = DigestTable()
+        self.cold_files = 0
+        self.state_lock = threading.Lock()
+        self.line_snapshots: OrderedDict = OrderedDict()
+        self.line_snapshot_bytes = 0
+        self.snapshot_lock = threading.Lock()
+        self.last_heartbeat: OrderedDict = OrderedDict()
         self.tracked_directories: Set[str] = set()
-        self.observers: List[Observer] = []
-        self.heartbeat_queue: List[Heartbeat] = []
+        self.ignore_engines: Dict[str, IgnoreEngine] = {}
+        self.git_resolver = GitBranchResolver()
+        self.project_resolver = ProjectResolver()
+        self.watchers: Dict[str, DirectoryWatcher] = {}
+        self.watch_lock = threading.RLock()
+        self.heartbeat_queue: Dict[int, List[Heartbeat]] = {}
+        self.compaction_stats = {'queued': 0, 'compacted': 0}
+        self.bulk_supported = True
+        self.send_policy = SendPolicy()
+        self.retry_after: Optional[float] = None
+        self.http_session: Optional[requests.Session] = None
+        self.session_generation = 0
+        self.http_session_generation = -1
+        self.send_stats = {'batches': 0, 'bulk_batches': 0, 'fallback_batches': 0, 'sent': 0, 'failed': 0,
+                           'last_batch_ms': 0.0, 'total_batch_ms': 0.0}
         self.lock = threading.Lock()
+        # Signalled when the sender should re-check whether a flush is due
+        self.flush_condition = threading.Condition(self.lock)
+        self.pending_heartbeat_count = 0
+        self.flush_stats = {'interval': 0, 'queue': 0, 'idle': 0, 'shutdown': 0}
+        self.stopping = False
         self.last_activity_time: float = 0
         self.is_tracking_active: bool = True
+        self.scan_stats: Dict[str, Dict] = {}
+        self.event_pipeline = EventPipeline(self.handle_file_change, config.event_workers, config.event_queue_size)
+        self.settle_scheduler = SettleScheduler(self.event_pipeline.put, config.settle_window, config.event_queue_size)
         self.sender_thread = threading.Thread(target=self._heartbeat_sender, daemon=True)
         self.sender_thread.start()
     
@@ -259,17 +2289,21 @@ class FileTracker:
             return True
         
         try:
-            event_handler = FileChangeHandler(self)
-            observer = Observer()
-            observer.schedule(event_handler, directory, recursive=True)
-            observer.start()
-            
-            self.observers.append(observer)
+            # One inotify instance per root; the initial scan adds a watch for each
+            # non-ignored directory as it walks the tree
+            watcher = DirectoryWatcher(directory, FileChangeHandler(self, directory))
+            with self.watch_lock:
+                self.watchers[directory] = watcher
+            for repository in self.git_resolver.discover_ancestors(directory):
+                self._watch_git_dir(directory, repository)
+            self.ignore_engines[directory] = IgnoreEngine(directory)
             self.tracked_directories.add(directory)
+            self.project_resolver.add(directory)
             print(f"DEBUG: Successfully added directory to tracking: {directory}")
             print(f"DEBUG: All tracked directories: {list(self.tracked_directories)}")
             
-            self._initial_scan(directory)
+            scan_thread = threading.Thread(target=self._initial_scan, args=(directory,), daemon=True)
+            scan_thread.start()
             return True
         except Exception as e:
             print(f"Error adding directory {directory}: {e}")
@@ -280,398 +2314,627 @@ class FileTracker:
         if directory not in self.tracked_directories:
             return False
         
-        for observer in self.observers[:]:
-            observer.stop()
-            observer.join()
+        with self.watch_lock:
+            watcher = self.watchers.pop(directory, None)
+        if watcher is not None:
+            watcher.stop()
         
-        self.observers.clear()
         self.tracked_directories.discard(directory)
-        
-        for tracked_dir in self.tracked_directories.copy():
-            self.tracked_directories.remove(tracked_dir)
-            self.add_directory(tracked_dir)
+        self.project_resolver.remove(directory)
+        self.ignore_engines.pop(directory, None)
+        self.scan_stats.pop(directory, None)
+        # The persistent index keeps these entries so re-tracking the directory stays cheap
+        hot_files = self._forget_tree_state(directory)
+        self._drop_cold_files(self.fingerprint_index.count_tree(directory) - hot_files)
         
         return True
     
-    def _initial_scan(self, directory: str):
-        for root, dirs, files in os.walk(directory):
+    def _watch_directory(self, root: str, directory: str, handler: Optional[FileSystemEventHandler] = None):
+        with self.watch_lock:
+            watcher = self.watchers.get(root)
+        if watcher is None:
+            return
+        try:
+            watcher.add(directory, handler)
+        except OSError as e:
+            print(f"DEBUG: Could not watch directory {directory}: {e}")
+    
+    def _unwatch_tree(self, root: str, directory: str):
+        with self.watch_lock:
+            watcher = self.watchers.get(root)
+        if watcher is not None:
+            watcher.remove_tree(directory)
+    
+    def _watch_git_dir(self, root: str, repository: GitRepository):
+        handler = GitHeadHandler(self.git_resolver)
+        self._watch_directory(root, repository.git_dir, handler)
+        if repository.common_dir != repository.git_dir:
+            self._watch_directory(root, repository.common_dir, handler)
+    
+    def _discover_git_repository(self, root: str, directory: str, dirs: List[str], files: List[str]):
+        if '.git' in dirs or '.git' in files:
+            repository = self.git_resolver.discover(directory)
+            if repository is not None:
+                self._watch_git_dir(root, repository)
+    
+    def handle_directory_created(self, root: str, directory: str, queue_files: bool = True):
+        """Watch a new directory tree and queue the files that landed in it before the watch existed"""
+        engine = self.ignore_engines.get(root)
+        if engine is None or engine.is_ignored(directory, True):
+            return
+        for dirpath, dirs, files in os.walk(directory):
+            self._discover_git_repository(root, dirpath, dirs, files)
+            dirs[:] = [d for d in dirs if not engine.is_ignored(os.path.join(dirpath, d), True, check_parents=False)]
+            self._watch_directory(root, dirpath)
             for file in files:
-                file_path = os.path.join(root, file)
-                if self._should_track_file(file_path):
-                    initial_hash = self._update_file_hash(file_path)
-                    if initial_hash:
-                        self.file_hashes[file_path] = initial_hash
-    
-    def _should_track_file(self, file_path: str) -> bool:
-        if any(part.startswith('.') for part in Path(file_path).parts):
-            return False
+                file_path = os.path.join(dirpath, file)
+                if queue_files and not engine.is_ignored(file_path, check_parents=False):
+                    self.queue_file_change(file_path, is_write=True)
+    
+    def handle_directory_removed(self, root: str, directory: str):
+        self._unwatch_tree(root, directory)
+        hot_files = self._forget_tree_state(directory)
+        self._drop_cold_files(self.fingerprint_index.remove_tree(directory) - hot_files)
+    
+    def _initial_scan(self, directory: str):
+        """Hash every trackable file under directory on a bounded thread pool"""
+        stats = {'state': 'scanning', 'files': 0, 'rehashed': 0, 'elapsed': 0.0, 'files_per_sec': 0.0}
+        self.scan_stats[directory] = stats
+        start = time.perf_counter()
+        indexed = self.fingerprint_index.load_directory(directory)
+        present: Set[str] = set()
+        engine = self.ignore_engines.get(directory) or IgnoreEngine(directory)
         
-        skip_extensions = {
-            '.exe', '.dll', '.so', '.dylib', '.bin', '.obj', '.o',
-            '.jpg', '.jpeg', '.png', '.gif', '.bmp', '.ico', '.svg',
-            '.mp3', '.mp4', '.avi', '.mov', '.wav', '.flac',
-            '.zip', '.tar', '.gz', '.7z', '.rar',
-            '.pdf', '.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx'
-        }
+        with ThreadPoolExecutor(max_workers=SCAN_WORKERS, thread_name_prefix='unitime-scan') as executor:
+            batch = []
+            for root, dirs, files in os.walk(directory):
+                if directory not in self.tracked_directories:
+                    stats['state'] = 'cancelled'
+                    break
+                self._discover_git_repository(directory, root, dirs, files)
+                # Pruning in place stops os.walk from ever descending into ignored trees
+                dirs[:] = [d for d in dirs if not engine.is_ignored(os.path.join(root, d), True, check_parents=False)]
+                self._watch_directory(directory, root)
+                for file in files:
+                    file_path = os.path.join(root, file)
+                    if not engine.is_ignored(file_path, check_parents=False):
+                        batch.append(file_path)
+                if len(batch) >= SCAN_BATCH_SIZE:
+                    self._scan_batch(executor, batch, indexed, present, stats)
+                    batch = []
+            if batch and stats['state'] == 'scanning':
+                self._scan_batch(executor, batch, indexed, present, stats)
+        
+        if stats['state'] == 'scanning':
+            self.fingerprint_index.remove_missing(directory, present)
+            stats['state'] = 'complete'
         
+        elapsed = time.perf_counter() - start
+        stats['elapsed'] = round(elapsed, 3)
+        stats['files_per_sec'] = round(stats['files'] / elapsed, 1) if elapsed > 0 else 0.0
+        print(f"DEBUG: Initial scan of {directory} {stats['state']}: {stats['files']} files "
+              f"({stats['rehashed']} rehashed) in {elapsed:.2f}s ({stats['files_per_sec']} files/sec)")
+    
+    def _scan_batch(self, executor: ThreadPoolExecutor, file_paths: List[str],
+                    indexed: Dict[str, Tuple[int, int, int, int]], present: Set[str], stats: Dict):
+        results = executor.map(self._scan_file, file_paths, [indexed.get(file_path) for file_path in file_paths])
+        changed_rows = []
+        for file_path, result in zip(file_paths, results):
+            if result is None:
+                continue
+            fingerprint, file_hash, rehashed = result
+            self._remember_file_state(self.path_registry.intern(file_path), fingerprint, file_hash)
+            present.add(file_path)
+            stats['files'] += 1
+            if rehashed:
+                stats['rehashed'] += 1
+                changed_rows.append((file_path, *fingerprint, file_hash))
+        self.fingerprint_index.put_many(changed_rows)
+    
+    def _scan_file(self, file_path: str, indexed: Optional[Tuple[int, int, int, int]]):
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return None
+        if not self._is_trackable_file(file_path, st):
+            return None
+        fingerprint = file_fingerprint(st)
+        if indexed is not None and indexed[:3] == fingerprint:
+            return fingerprint, indexed[3], False
+        file_hash = self._hash_file(file_path)
+        if file_hash is None:
+            return None
+        return fingerprint, file_hash, True
+    
+    def _is_ignored(self, file_path: str) -> bool:
+        root = self.project_resolver.root_for(file_path)
+        engine = self.ignore_engines.get(root) if root else None
+        if engine is None:
+            return any(part.startswith('.') for part in Path(file_path).parts)
+        return engine.is_ignored(file_path)
+    
+    def _should_track_file(self, file_path: str, st: Optional[os.stat_result] = None) -> bool:
+        if self._is_ignored(file_path):
+            return False
+        return self._is_trackable_file(file_path, st)
+    
+    def _is_trackable_file(self, file_path: str, st: Optional[os.stat_result] = None) -> bool:
         file_ext = Path(file_path).suffix.lower()
-        if file_ext in skip_extensions:
+        if file_ext in SKIP_EXTENSIONS:
             return False
         
         try:
-            if os.path.getsize(file_path) > MAX_FILE_SIZE:
-                return False
+            size = st.st_size if st is not None else os.path.getsize(file_path)
         except OSError:
             return False
+        if size > MAX_FILE_SIZE:
+            return False
         
         return True
     
-    def _update_file_hash(self, file_path: str) -> str:
+    def _inspect_file(self, file_path: str) -> Optional[FileInspection]:
         try:
-            time.sleep(0.1)
-            
-            with open(file_path, 'rb') as f:
-                content = f.read()
-                file_hash = hashlib.md5(content).hexdigest()
-                return file_hash
+            return self.hasher.inspect_file(file_path, line_hashes=True)
         except (OSError, IOError) as e:
             print(f"DEBUG: Error reading file {file_path}: {e}")
             return None
     
-    def _get_file_language(self, file_path: str) -> Optional[str]:
-        extension_map = {
-            '.py': 'Python',
-            '.pyi': 'Python',
-            '.pyx': 'Cython',
-            '.pxd': 'Cython',
-            '.pyd': 'Python',
-            '.ipynb': 'Jupyter Notebook',
-            '.js': 'JavaScript',
-            '.jsx': 'React JSX',
-            '.ts': 'TypeScript',
-            '.tsx': 'React TSX',
-            '.vue': 'Vue',
-            '.svelte': 'Svelte',
-            '.html': 'HTML',
-            '.htm': 'HTML',
-            '.xhtml': 'XHTML',
-            '.css': 'CSS',
-            '.scss': 'SCSS',
-            '.sass': 'Sass',
-            '.less': 'Less',
-            '.php': 'PHP',
-            '.wasm': 'WebAssembly',
-            '.java': 'Java',
-            '.kt': 'Kotlin',
-            '.kts': 'Kotlin Script',
-            '.scala': 'Scala',
-            '.sc': 'Scala Script',
-            '.groovy': 'Groovy',
-            '.gvy': 'Groovy',
-            '.gradle': 'Gradle',
-            '.clj': 'Clojure',
-            '.cljs': 'ClojureScript',
-            '.cs': 'C#',
-            '.vb': 'Visual Basic',
-            '.fs': 'F#',
-            '.fsx': 'F# Script',
-            '.xaml': 'XAML',
-            '.c': 'C',
-            '.cpp': 'C++',
-            '.cc': 'C++',
-            '.cxx': 'C++',
-            '.cp': 'C++',
-            '.c++': 'C++',
-            '.h': 'C Header',
-            '.hpp': 'C++ Header',
-            '.hh': 'C++ Header',
-            '.hxx': 'C++ Header',
-            '.inl': 'C++ Inline',
-            '.cu': 'CUDA',
-            '.cuh': 'CUDA Header',
-            '.rs': 'Rust',
-            '.go': 'Go',
-            '.swift': 'Swift',
-            '.d': 'D',
-            '.zig': 'Zig',
-            '.nim': 'Nim',
-            '.cr': 'Crystal',
-            '.odin': 'Odin',
-            '.rb': 'Ruby',
-            '.erb': 'ERB',
-            '.rake': 'Ruby Rake',
-            '.pl': 'Perl',
-            '.pm': 'Perl Module',
-            '.t': 'Perl Test',
-            '.lua': 'Lua',
-            '.tcl': 'Tcl',
-            '.rb': 'Ruby',
-            '.php': 'PHP',
-            '.sh': 'Shell',
-            '.bash': 'Bash',
-            '.zsh': 'Zsh',
-            '.fish': 'Fish',
-            '.ps1': 'PowerShell',
-            '.psm1': 'PowerShell Module',
-            '.psd1': 'PowerShell Data',
-            '.bat': 'Batch',
-            '.cmd': 'Batch',
-            '.json': 'JSON',
-            '.yaml': 'YAML',
-            '.yml': 'YAML',
-            '.toml': 'TOML',
-            '.ini': 'INI',
-            '.xml': 'XML',
-            '.csv': 'CSV',
-            '.tsv': 'TSV',
-            '.sql': 'SQL',
-            '.graphql': 'GraphQL',
-            '.gql': 'GraphQL',
-            '.proto': 'Protocol Buffers',
-            '.avdl': 'Avro IDL',
-            '.thrift': 'Thrift',
-            '.hs': 'Haskell',
-            '.lhs': 'Literate Haskell',
-            '.ml': 'OCaml',
-            '.mli': 'OCaml Interface',
-            '.elm': 'Elm',
-            '.erl': 'Erlang',
-            '.ex': 'Elixir',
-            '.exs': 'Elixir Script',
-            '.gleam': 'Gleam',
-            '.lisp': 'Lisp',
-            '.cl': 'Common Lisp',
-            '.rkt': 'Racket',
-            '.r': 'R',
-            '.jl': 'Julia',
-            '.m': 'MATLAB/Objective-C',
-            '.mm': 'Objective-C++',
-            '.f': 'Fortran',
-            '.f90': 'Fortran 90',
-            '.f95': 'Fortran 95',
-            '.f03': 'Fortran 2003',
-            '.stan': 'Stan',
-            '.dart': 'Dart',
-            '.swift': 'Swift',
-            '.kt': 'Kotlin',
-            '.java': 'Java',
-            '.m': 'Objective-C',
-            '.mm': 'Objective-C++',
-            '.gd': 'GDScript',
-            '.cs': 'C# (Unity)',
-            '.hlsl': 'HLSL',
-            '.glsl': 'GLSL',
-            '.shader': 'Unity Shader',
-            '.as': 'ActionScript',
-            '.md': 'Markdown',
-            '.mdx': 'MDX',
-            '.rst': 'reStructuredText',
-            '.tex': 'LaTeX',
-            '.wiki': 'Wiki',
-            '.org': 'Org Mode',
-            '.adoc': 'AsciiDoc',
-            '.vim': 'Vim Script',
-            '.asm': 'Assembly',
-            '.s': 'Assembly',
-            '.nasm': 'NASM',
-            '.v': 'Verilog/V',
-            '.vhd': 'VHDL',
-            '.cmake': 'CMake',
-            '.make': 'Makefile',
-            '.nix': 'Nix',
-            '.awk': 'AWK',
-            '.ahk': 'AutoHotkey',
-            '.applescript': 'AppleScript',
-            '.bf': 'Brainfuck',
-            '.io': 'Io',
-            '.j': 'J',
-            '.hy': 'Hy',
-        }
-        
-        ext = Path(file_path).suffix.lower()
-        language = extension_map.get(ext)
-        
-        if ext == '.m':
-            try:
-                with open(file_path, 'r', errors='ignore') as f:
-                    content = f.read(4096)
-                    if '@interface' in content or '@implementation' in content or '#import' in content:
-                        return 'Objective-C'
-                    elif 'function ' in content or '];\n' in content:
-                        return 'MATLAB'
-            except:
-                pass
-        
-        return language
+    def _hash_file(self, file_path: str) -> Optional[int]:
+        try:
+            return self.hasher.hash_file(file_path)
+        except (OSError, IOError) as e:
+            print(f"DEBUG: Error reading file {file_path}: {e}")
+            return None
+    
+    def _load_file_state(self, path_id: Optional[int], file_path: str) -> Tuple[Optional[Tuple[int, int, int]], Optional[int], bool]:
+        """Return (fingerprint, digest, from_index), falling back to the index for evicted files"""
+        if path_id is not None:
+            with self.state_lock:
+                state = self.file_table.get(path_id)
+            if state is not None:
+                return state[0], state[1], False
+        indexed = self.fingerprint_index.get(file_path)
+        if indexed is None:
+            return None, None, False
+        return indexed[:3], indexed[3], True
+    
+    def _remember_file_state(self, path_id: int, fingerprint: Tuple[int, int, int], digest: int,
+                             from_index: bool = False):
+        with self.state_lock:
+            if from_index and path_id not in self.file_table:
+                self.cold_files = max(0, self.cold_files - 1)
+            self.file_table.put(path_id, fingerprint, digest)
+            if len(self.file_table) > self.max_file_entries:
+                # Evict in batches so the scan for the coldest entries is amortized
+                batch = max(1, self.max_file_entries // 16)
+                self.cold_files += len(self.file_table.evict_coldest(batch))
+    
+    def _forget_file_state(self, path_id: int) -> bool:
+        with self.state_lock:
+            in_memory = self.file_table.pop(path_id)
+        with self.snapshot_lock:
+            snapshot = self.line_snapshots.pop(path_id, None)
+            if snapshot is not None:
+                self.line_snapshot_bytes -= len(snapshot) * snapshot.itemsize
+        with self.lock:
+            self.last_heartbeat.pop(path_id, None)
+        return in_memory
+    
+    def _forget_tree_state(self, directory: str) -> int:
+        """Drop the in-memory state under directory and return how many files had a table row"""
+        hot_files = 0
+        for path_id in self.path_registry.descendants(directory):
+            hot_files += self._forget_file_state(path_id)
+        self.path_registry.release(directory)
+        return hot_files
+    
+    def _drop_cold_files(self, count: int):
+        """Stop counting evicted files whose index rows are gone or no longer under a tracked directory"""
+        # Every file with a table row is also in the index, so the rest of the rows were evicted
+        if count > 0:
+            with self.state_lock:
+                self.cold_files = max(0, self.cold_files - count)
+    
+    def handle_file_removed(self, file_path: str):
+        path_id = self.path_registry.release(file_path)
+        in_memory = path_id is not None and self._forget_file_state(path_id)
+        LANGUAGE_CLASSIFIER.forget(file_path)
+        if self.fingerprint_index.remove(file_path) and not in_memory:
+            self._drop_cold_files(1)
+    
+    def handle_file_moved(self, src_path: str, dest_path: str):
+        """Carry a renamed file's state over so a pure rename does not look like an edit"""
+        fingerprint, digest, from_index = self._load_file_state(self.path_registry.lookup(src_path), src_path)
+        if digest is not None and fingerprint is not None:
+            self.handle_file_removed(dest_path)
+            # Relinking keeps the id, so the table entry and line snapshot follow the file
+            path_id = self.path_registry.move(src_path, dest_path)
+            if path_id is None:
+                path_id = self.path_registry.intern(dest_path)
+            LANGUAGE_CLASSIFIER.forget(src_path)
+            self.fingerprint_index.remove(src_path)
+            self._remember_file_state(path_id, fingerprint, digest, from_index)
+            self.fingerprint_index.put(dest_path, fingerprint, digest)
+        # Editors that save through a temp file and rename it over the target land here too
+        self.queue_file_change(dest_path, is_write=False)
+    
+    def handle_directory_moved(self, root: str, src_path: str, dest_path: str):
+        self._unwatch_tree(root, src_path)
+        self._forget_tree_state(dest_path)
+        self.path_registry.move(src_path, dest_path)
+        self.fingerprint_index.move(src_path, dest_path)
+        self.handle_directory_created(root, dest_path, queue_files=False)
+    
+    def _update_line_snapshot(self, path_id: int, line_hashes: Optional[array]) -> Optional[Tuple[int, int, int]]:
+        """Swap in the new line-hash snapshot and diff it against the previous one, if any"""
+        with self.snapshot_lock:
+            previous = self.line_snapshots.pop(path_id, None)
+            if previous is not None:
+                self.line_snapshot_bytes -= len(previous) * previous.itemsize
+            if line_hashes is not None:
+                self.line_snapshots[path_id] = line_hashes
+                self.line_snapshot_bytes += len(line_hashes) * line_hashes.itemsize
+                while self.line_snapshot_bytes > self.line_snapshot_budget and len(self.line_snapshots) > 1:
+                    _, evicted = self.line_snapshots.popitem(last=False)
+                    self.line_snapshot_bytes -= len(evicted) * evicted.itemsize
+        if previous is None or line_hashes is None:
+            return None
+        return diff_line_hashes(previous, line_hashes)
+    
+    def _get_file_language(self, file_path: str, head: Optional[bytes] = None, inode: Optional[int] = None) -> Optional[str]:
+        return LANGUAGE_CLASSIFIER.classify(file_path, head, inode)
     
     def _get_git_branch(self, file_path: str) -> str:
-        try:
-            path = Path(file_path)
-            for parent in [path.parent] + list(path.parents):
-                git_dir = parent / '.git'
-                if git_dir.exists():
-                    head_file = git_dir / 'HEAD'
-                    if head_file.exists():
-                        with open(head_file, 'r') as f:
-                            head_content = f.read().strip()
-                            if head_content.startswith('ref: refs/heads/'):
-                                return head_content.replace('ref: refs/heads/', '')
-                    break
-        except Exception:
-            pass
-        return "main"
+        return self.git_resolver.branch_for(file_path) or "main"
     
     def _get_project_name(self, file_path: str) -> Optional[str]:
-        file_path = os.path.abspath(file_path)
-        
-        for tracked_dir in self.tracked_directories:
-            normalized_tracked_dir = os.path.abspath(tracked_dir)
-            if file_path.startswith(normalized_tracked_dir):
-                project_name = Path(normalized_tracked_dir).name
-                print(f"DEBUG: File {file_path} -> Project {project_name} (from tracked dir {normalized_tracked_dir})")
-                return project_name
-        
-        fallback_name = Path(file_path).parent.name
-        print(f"DEBUG: File {file_path} -> Project {fallback_name} (fallback - no matching tracked dir)")
-        print(f"DEBUG: Tracked directories: {list(self.tracked_directories)}")
-        return fallback_name
+        return self.project_resolver.project_for(os.path.abspath(file_path)) or Path(file_path).parent.name
     
-    def _count_lines(self, file_path: str) -> Optional[int]:
-        try:
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                return sum(1 for _ in f)
-        except (OSError, IOError):
-            return None
+    def queue_file_change(self, file_path: str, is_write: bool = False):
+        directory, name = os.path.split(file_path)
+        if name in IGNORE_FILES:
+            for engine in self.ignore_engines.values():
+                engine.invalidate(directory)
+            return
+        if name == PROJECT_FILE:
+            self.project_resolver.invalidate_overrides()
+            return
+        self.settle_scheduler.schedule(file_path, is_write)
+    
+    def queue_structural_change(self, key: str, handler, *args):
+        """Run a delete/move/new-directory handler on the event workers instead of the watchdog thread"""
+        self.event_pipeline.submit(key, lambda: handler(*args))
     
     def handle_file_change(self, file_path: str, is_write: bool = False):
         print(f"DEBUG: Processing file change: {file_path}")
         
-        if not self._should_track_file(file_path):
+        try:
+            st = os.stat(file_path)
+        except OSError as e:
+            print(f"DEBUG: Could not stat file {file_path}: {e}")
+            return
+        
+        if not self._should_track_file(file_path, st):
             print(f"DEBUG: File not tracked (filtered out): {file_path}")
             return
         
+        fingerprint = file_fingerprint(st)
+        path_id = self.path_registry.intern(file_path)
+        known_fingerprint, old_hash, from_index = self._load_file_state(path_id, file_path)
+        if not is_write and known_fingerprint == fingerprint:
+            print(f"DEBUG: File {file_path} stat unchanged, skipping without reading")
+            return
+        
         now = time.time()
         
+        self.last_activity_time = now
         if not self.is_tracking_active:
             print(f"Activity detected after timeout - reactivating tracking for {file_path}")
             self.is_tracking_active = True
+            # Let the sender arm its idle deadline again
+            self.reschedule_flush()
         
-        self.last_activity_time = now
-        old_hash = self.file_hashes.get(file_path)
-        
-        current_hash = self._update_file_hash(file_path)
-        if current_hash is None:
+        inspection = self._inspect_file(file_path)
+        if inspection is None:
             print(f"DEBUG: Could not read file {file_path}, skipping heartbeat")
             return
+        current_hash = inspection.digest
+        
+        self._remember_file_state(path_id, fingerprint, current_hash, from_index)
+        if known_fingerprint != fingerprint or old_hash != current_hash:
+            self.fingerprint_index.put(file_path, fingerprint, current_hash)
         
         if old_hash == current_hash and not is_write:
-            print(f"DEBUG: File {file_path} unchanged (hash: {current_hash[:8]}...), skipping heartbeat")
+            print(f"DEBUG: File {file_path} unchanged (hash: {current_hash:016x}), skipping heartbeat")
             return
         
         if old_hash != current_hash:
-            print(f"DEBUG: File {file_path} changed (old: {old_hash[:8] if old_hash else 'None'}... -> new: {current_hash[:8]}...)")
-            self.file_hashes[file_path] = current_hash
+            print(f"DEBUG: File {file_path} changed (old: {f'{old_hash:016x}' if old_hash is not None else 'None'} -> new: {current_hash:016x})")
         elif is_write:
             print(f"DEBUG: File {file_path} write event detected")
-            self.file_hashes[file_path] = current_hash
         
-        total_lines = self._count_lines(file_path)
+        total_lines = inspection.lines
+        line_diff = self._update_line_snapshot(path_id, inspection.line_hashes)
+        if line_diff is not None:
+            lineno, line_additions, line_deletions = line_diff
+            lineno = max(1, min(lineno, total_lines))
+        else:
+            lineno, line_additions, line_deletions = total_lines if total_lines else 1, None, None
         heartbeat = Heartbeat(
-            entity=file_path,
+            entity_id=path_id,
             time=int(now),
             category="coding",
             project=self._get_project_name(file_path),
             branch=self._get_git_branch(file_path),
-            language=self._get_file_language(file_path),
-            lineno=total_lines if total_lines else 1,
+            language=self._get_file_language(file_path, inspection.head, fingerprint[2]),
+            lineno=lineno,
             cursorpos=0,
             lines=total_lines,
             is_write=is_write,
-            plugin=build_plugin_name(self.config.editor_name)
+            plugin=build_plugin_name(self.config.editor_name),
+            line_additions=line_additions,
+            line_deletions=line_deletions
         )
         
-        print(f"DEBUG: Queuing heartbeat for {file_path} (will be sent within 30 seconds)")
+        print(f"DEBUG: Queuing heartbeat for {file_path} (will be sent within {self._flush_interval():.0f} seconds)")
         
         with self.lock:
-            self.heartbeat_queue = [hb for hb in self.heartbeat_queue if hb.entity != file_path]
-            self.heartbeat_queue.append(heartbeat)
-            self.last_heartbeat[file_path] = now
+            # The path may have been released (and its id reclaimed) while the file was being read
+            if self.path_registry.lookup(file_path) != path_id:
+                print(f"DEBUG: {file_path} was removed while it was being read, dropping heartbeat")
+                return
+            self._enqueue_heartbeat(path_id, heartbeat)
+            self.last_heartbeat.pop(path_id, None)
+            self.last_heartbeat[path_id] = now
+            while len(self.last_heartbeat) > RECENT_HEARTBEATS_LIMIT:
+                self.last_heartbeat.popitem(last=False)
+    
+    def _enqueue_heartbeat(self, path_id: int, heartbeat: Heartbeat):
+        """Add a heartbeat to the file's pending run, compacting it per config (caller holds self.lock)"""
+        self.compaction_stats['queued'] += 1
+        pending = self.heartbeat_queue.get(path_id)
+        mode = self.config.heartbeat_compaction
+        if pending is None:
+            self.heartbeat_queue[path_id] = [heartbeat]
+        elif mode == 'latest' or (mode == 'span' and len(pending) > 1
+                                  and pending[-2].is_write == pending[-1].is_write == heartbeat.is_write):
+            # Still inside the same run, so the new heartbeat replaces its tentative end
+            pending[-1] = heartbeat
+            self.compaction_stats['compacted'] += 1
+            return
+        else:
+            pending.append(heartbeat)
+        self.pending_heartbeat_count += 1
+        # The sender may be asleep with no deadline, or the queue may have reached a full batch
+        if self.pending_heartbeat_count == 1 or self.pending_heartbeat_count >= self.config.heartbeat_batch_size:
+            self.flush_condition.notify()
     
     def _heartbeat_sender(self):
-        last_heartbeat_sent = 0
-        
+        last_flush = time.monotonic()
         while True:
+            with self.flush_condition:
+                reason, timeout = self._flush_reason(last_flush)
+                while reason is None:
+                    self.flush_condition.wait(timeout)
+                    reason, timeout = self._flush_reason(last_flush)
+                self.flush_stats[reason] += 1
+            
             try:
-                now = time.time()
-                if self.last_activity_time > 0:
-                    time_since_last_activity = now - self.last_activity_time
-
-                    if time_since_last_activity <= 30 and (now - last_heartbeat_sent) >= 30:
-                        heartbeats_to_send = []
-                        with self.lock:
-                            if self.heartbeat_queue:
-                                heartbeats_to_send = self.heartbeat_queue[:]
-                                self.heartbeat_queue.clear()
-                        
-                        if heartbeats_to_send:
-                            print(f"DEBUG: Sending {len(heartbeats_to_send)} heartbeat(s) - activity detected within last 30 seconds")
-                            self._send_heartbeats(heartbeats_to_send)
-                            last_heartbeat_sent = now
-                        else:
-                            print(f"DEBUG: No queued heartbeats to send (activity detected but no file changes)")
-                    
-                    if time_since_last_activity > ACTIVITY_TIMEOUT:
-                        if self.is_tracking_active:
-                            print(f"DEBUG: No activity for {ACTIVITY_TIMEOUT} seconds - pausing heartbeat tracking")
-                            self.is_tracking_active = False
-                        with self.lock:
-                            if self.heartbeat_queue:
-                                print(f"DEBUG: Clearing {len(self.heartbeat_queue)} queued heartbeats due to inactivity")
-                                self.heartbeat_queue.clear()
-                    else:
-                        if not self.is_tracking_active:
-                            print(f"DEBUG: Activity detected - reactivating tracking")
-                            self.is_tracking_active = True
-                
-                time.sleep(30)
-                
+                if reason == 'idle':
+                    print(f"DEBUG: No activity for {ACTIVITY_TIMEOUT} seconds - pausing heartbeat tracking")
+                    self.is_tracking_active = False
+                if self._persist_heartbeat_queue() or len(self.outbox):
+                    print(f"DEBUG: Sending {len(self.outbox)} heartbeat(s) from the outbox ({reason} flush)")
+                    self._drain_outbox()
             except Exception as e:
                 print(f"Error in heartbeat sender: {e}")
-                time.sleep(30)
+            
+            last_flush = time.monotonic()
+            if reason == 'shutdown':
+                return
     
-    def _send_heartbeats(self, heartbeats: List[Heartbeat]):
+    def _flush_interval(self) -> float:
+        try:
+            return max(1.0, float(self.config.heartbeat_interval))
+        except (TypeError, ValueError):
+            return float(DEFAULT_HEARTBEAT_INTERVAL)
+    
+    def _flush_reason(self, last_flush: float) -> Tuple[Optional[str], Optional[float]]:
+        """Why the sender should flush now, or else how long it may sleep (None until notified); caller holds self.lock"""
+        if self.stopping:
+            return 'shutdown', None
+        if self.pending_heartbeat_count >= self.config.heartbeat_batch_size:
+            return 'queue', None
+        waits = []
+        if self.is_tracking_active and self.last_activity_time > 0:
+            idle_in = self.last_activity_time + ACTIVITY_TIMEOUT - time.time()
+            if idle_in <= 0:
+                return 'idle', None
+            waits.append(idle_in)
+        if self.pending_heartbeat_count or len(self.outbox):
+            due_in = last_flush + self._flush_interval() - time.monotonic()
+            if not self.pending_heartbeat_count:
+                # Only a backlog is left, so there is no point waking before the send policy allows a retry
+                due_in = max(due_in, self.send_policy.retry_in())
+            if due_in <= 0:
+                return 'interval', None
+            waits.append(due_in)
+        return None, min(waits) if waits else None
+    
+    def reschedule_flush(self):
+        """Wake the sender so a new heartbeat interval takes effect right away"""
+        with self.flush_condition:
+            self.flush_condition.notify()
+    
+    def _persist_heartbeat_queue(self) -> int:
+        """Move every queued heartbeat into the durable outbox, resolving entity paths on the way"""
+        with self.lock:
+            pending, self.heartbeat_queue = self.heartbeat_queue, {}
+            self.pending_heartbeat_count = 0
+            # handle_file_change re-checks its id under this lock before queueing, so ids released
+            # before the swap are referenced only by the heartbeats taken here
+            released = self.path_registry.take_released()
+        rows = [(heartbeat.time, heartbeat.to_bytes(self._heartbeat_entity(heartbeat)))
+                for run in pending.values() for heartbeat in run]
+        self.outbox.put_many(rows)
+        # A worker that read the file after its release may have stored state under the old id
+        for path_id in released:
+            self._forget_file_state(path_id)
+        self.path_registry.reclaim(released)
+        return len(rows)
+    
+    def _drain_outbox(self) -> int:
+        """Send outbox heartbeats oldest first until it is empty or the server stops taking them"""
         if not self.config.api_key:
             print("Warning: No API key configured")
-            return
+            return 0
+        sent = 0
+        while True:
+            if not self.send_policy.allow():
+                print(f"DEBUG: Holding {len(self.outbox)} heartbeat(s), next attempt in {self.send_policy.retry_in():.0f}s")
+                return sent
+            # While half-open a single heartbeat is enough to find out whether the API is back
+            rows = self.outbox.peek(1 if self.send_policy.probing() else self.config.heartbeat_batch_size)
+            if not rows:
+                return sent
+            statuses = self._send_batch([payload for _, payload in rows])
+            acknowledged, rejected = [], []
+            for (row_id, _), status in zip(rows, statuses):
+                if is_accepted(status):
+                    acknowledged.append(row_id)
+                elif status is not None and 400 <= status < 500 and status not in RETRYABLE_CLIENT_STATUSES:
+                    rejected.append(row_id)
+            if rejected:
+                print(f"DEBUG: Server refused {len(rejected)} heartbeat(s), dropping them")
+            self.outbox.acknowledge(acknowledged, rejected)
+            sent += len(acknowledged)
+            if acknowledged or rejected:
+                self.send_policy.record_success()
+            else:
+                self.send_policy.record_failure(self.retry_after)
+            if len(acknowledged) + len(rejected) < len(rows):
+                # Leave the rest for the next flush instead of hammering a failing server
+                return sent
+    
+    def _heartbeat_entity(self, heartbeat: Heartbeat) -> str:
+        if heartbeat.entity_id is not None:
+            return self.path_registry.path(heartbeat.entity_id)
+        return heartbeat.entity
+    
+    def reset_http_session(self):
+        """Rebuild the sender's session on its next request, e.g. after the API key or URL changed"""
+        self.session_generation += 1
+    
+    def _http_session(self) -> requests.Session:
+        # Only the sender thread touches the session, so it is swapped here rather than from the request handler
+        if self.http_session is None or self.http_session_generation != self.session_generation:
+            if self.http_session is not None:
+                self.http_session.close()
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=SENDER_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update({
+                'Authorization': f'Bearer {self.config.api_key}',
+                'Content-Type': 'application/json'
+            })
+            self.http_session = session
+            self.http_session_generation = self.session_generation
+            self.bulk_supported = True
+        return self.http_session
+    
+    def _post(self, endpoint: str, body: bytes) -> requests.Response:
+        # Built per request so it follows runtime detection, which may finish or be refreshed after the session exists
+        headers = {'User-Agent': build_user_agent(self.config.editor_name)}
+        if self.config.compress_requests and len(body) >= GZIP_MIN_BYTES:
+            body = gzip.compress(body, compresslevel=6)
+            headers['Content-Encoding'] = 'gzip'
+        response = self._http_session().post(f"{self.config.api_url}{endpoint}", data=body, headers=headers, timeout=10)
+        if response.status_code in (429, 503):
+            self.retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        return response
+    
+    def _send_batch(self, payloads: List[bytes]) -> List[Optional[int]]:
+        """Send one batch of serialized heartbeats and return the per-item status codes (None when unsent)"""
+        began = time.perf_counter()
+        self.retry_after = None
+        statuses = self._send_bulk(payloads) if self.bulk_supported else None
+        if statuses is None:
+            self.send_stats['fallback_batches'] += 1
+            statuses = []
+            for payload in payloads:
+                status = self._send_one(payload)
+                statuses.append(status)
+                if status is None or status >= 500 or status in RETRYABLE_CLIENT_STATUSES:
+                    # The server is struggling, so do not spend a timeout on every remaining item
+                    statuses.extend([None] * (len(payloads) - len(statuses)))
+                    break
+        elapsed_ms = (time.perf_counter() - began) * 1000
         
-        headers = {
-            'Authorization': f'Bearer {self.config.api_key}',
-            'Content-Type': 'application/json',
-            'User-Agent': build_user_agent(self.config.editor_name)
-        }
+        accepted = sum(1 for status in statuses if is_accepted(status))
+        self.send_stats['batches'] += 1
+        self.send_stats['sent'] += accepted
+        self.send_stats['failed'] += len(payloads) - accepted
+        self.send_stats['last_batch_ms'] = round(elapsed_ms, 1)
+        self.send_stats['total_batch_ms'] += elapsed_ms
+        print(f"DEBUG: Sent batch of {len(payloads)} heartbeat(s): {accepted} accepted in {elapsed_ms:.0f} ms")
+        return statuses
+    
+    def _send_bulk(self, batch: List[bytes]) -> Optional[List[Optional[int]]]:
+        """POST a batch to heartbeats.bulk; returns None when the server will not take bulk requests"""
+        body = b'[' + b','.join(batch) + b']'
+        try:
+            response = self._post("/users/current/heartbeats.bulk", body)
+        except requests.RequestException as e:
+            print(f"DEBUG: Error sending heartbeat batch: {e}")
+            return [None] * len(batch)
         
-        for heartbeat in heartbeats:
-            try:
-                data = {k: v for k, v in asdict(heartbeat).items() if v is not None}
-                
-                print(f"DEBUG: Sending heartbeat data:")
-                print(f"  URL: {self.config.api_url}/users/current/heartbeats")
-                print(f"  Data: {json.dumps(data, indent=2)}")
-                
-                response = requests.post(
-                    f"{self.config.api_url}/users/current/heartbeats",
-                    headers=headers,
-                    json=data,
-                    timeout=10
-                )
-                
-                if response.status_code in [201, 202]:
-                    print(f"DEBUG: Heartbeat sent successfully for {heartbeat.entity} (status: {response.status_code})")
-                else:
-                    print(f"DEBUG: Failed to send heartbeat: {response.status_code} - {response.text}")
-                    
-            except requests.RequestException as e:
-                print(f"DEBUG: Error sending heartbeat: {e}")
+        if response.status_code in BULK_UNSUPPORTED_STATUSES:
+            print(f"DEBUG: Bulk heartbeats not supported by {self.config.api_url} ({response.status_code}), sending one at a time")
+            self.bulk_supported = False
+            return None
+        if not is_accepted(response.status_code):
+            print(f"DEBUG: Bulk heartbeat request rejected: {response.status_code} - {response.text}")
+            return None if response.status_code in (400, 413) else [response.status_code] * len(batch)
+        
+        self.send_stats['bulk_batches'] += 1
+        try:
+            results = response.json().get('responses')
+        except (ValueError, AttributeError):
+            results = None
+        if not isinstance(results, list) or len(results) != len(batch):
+            return [response.status_code] * len(batch)
+        # Each item is [response body, status code]
+        return [item[1] if isinstance(item, list) and len(item) > 1 else response.status_code for item in results]
+    
+    def _send_one(self, payload: bytes) -> Optional[int]:
+        try:
+            response = self._post("/users/current/heartbeats", payload)
+        except requests.RequestException as e:
+            print(f"DEBUG: Error sending heartbeat: {e}")
+            return None
+        
+        if is_accepted(response.status_code):
+            print(f"DEBUG: Heartbeat sent successfully (status: {response.status_code})")
+        else:
+            print(f"DEBUG: Failed to send heartbeat: {response.status_code} - {response.text}")
+        return response.status_code
+    
+    def _file_table_bytes(self) -> int:
+        with self.state_lock:
+            return self.file_table.memory_bytes()
+    
+    def _sender_stats(self) -> Dict:
+        stats = dict(self.send_stats, bulk_supported=self.bulk_supported,
+                     batch_size=self.config.heartbeat_batch_size)
+        total_ms = stats.pop('total_batch_ms')
+        stats['avg_batch_ms'] = round(total_ms / stats['batches'], 1) if stats['batches'] else 0.0
+        return stats
+    
+    def _recent_heartbeats(self) -> Dict[str, float]:
+        with self.lock:
+            recent = list(self.last_heartbeat.items())
+        return {self.path_registry.path(path_id): sent_at for path_id, sent_at in recent}
     
     def get_stats(self) -> Dict:
         now = time.time()
@@ -679,33 +2942,92 @@ class FileTracker:
         
         return {
             'tracked_directories': list(self.tracked_directories),
-            'tracked_files': len(self.file_hashes),
-            'pending_heartbeats': len(self.heartbeat_queue),
-            'last_heartbeats': dict(self.last_heartbeat),
+            'tracked_files': len(self.file_table) + self.cold_files,
+            'memory': {
+                'budget_mb': self.config.memory_budget_mb,
+                'hot_files': len(self.file_table),
+                'file_table_bytes': self._file_table_bytes(),
+                'path_nodes': len(self.path_registry),
+                'path_registry_bytes': self.path_registry.memory_bytes(),
+                'cold_files': self.cold_files,
+                'max_hot_files': self.max_file_entries,
+                'line_snapshot_bytes': self.line_snapshot_bytes
+            },
+            'pending_heartbeats': self.pending_heartbeat_count,
+            'heartbeat_compaction': dict(self.compaction_stats, mode=self.config.heartbeat_compaction),
+            'last_heartbeats': self._recent_heartbeats(),
             'is_tracking_active': self.is_tracking_active,
             'time_since_last_activity': round(time_since_last_activity, 1),
             'heartbeat_interval': self.config.heartbeat_interval,
-            'activity_timeout': ACTIVITY_TIMEOUT
+            'flushes': dict(self.flush_stats),
+            'activity_timeout': ACTIVITY_TIMEOUT,
+            'scans': {directory: dict(stats) for directory, stats in self.scan_stats.items()},
+            'watches': {directory: len(watcher.directories) for directory, watcher in self.watchers.items()},
+            'event_scheduler': self.settle_scheduler.get_stats(),
+            'event_pipeline': self.event_pipeline.get_stats(),
+            'sender': self._sender_stats(),
+            'outbox': self.outbox.get_stats(),
+            'circuit_breaker': self.send_policy.get_stats()
         }
     
     def stop(self):
-        for observer in self.observers:
-            observer.stop()
-            observer.join()
+        for watcher in list(self.watchers.values()):
+            watcher.stop()
+        self.settle_scheduler.stop()
+        self.event_pipeline.stop()
+        with self.flush_condition:
+            self.stopping = True
+            self.flush_condition.notify()
+        self.sender_thread.join(SHUTDOWN_FLUSH_TIMEOUT)
+        self.fingerprint_index.close()
+        # Anything the sender did not get to in time is kept for the next session
+        self._persist_heartbeat_queue()
+        self.outbox.close()
 
 class FileChangeHandler(FileSystemEventHandler):
-    def __init__(self, tracker: FileTracker):
+    def __init__(self, tracker: FileTracker, root: str):
         self.tracker = tracker
+        self.root = root
     
     def on_modified(self, event):
         if not event.is_directory:
-            self.tracker.handle_file_change(event.src_path, is_write=False)
+            self.tracker.queue_file_change(event.src_path, is_write=False)
     
     def on_created(self, event):
-        if not event.is_directory:
-            self.tracker.handle_file_change(event.src_path, is_write=True)
+        if event.is_directory:
+            # The walk and ignore matching would otherwise stall the emitter thread
+            self.tracker.queue_structural_change(event.src_path, self.tracker.handle_directory_created,
+                                                 self.root, event.src_path)
+        else:
+            self.tracker.queue_file_change(event.src_path, is_write=True)
+    
+    def on_deleted(self, event):
+        if event.is_directory:
+            self.tracker.queue_structural_change(event.src_path, self.tracker.handle_directory_removed,
+                                                 self.root, event.src_path)
+        else:
+            self.tracker.queue_structural_change(event.src_path, self.tracker.handle_file_removed, event.src_path)
+    
+    def on_moved(self, event):
+        if event.is_directory:
+            self.tracker.queue_structural_change(event.src_path, self.tracker.handle_directory_moved,
+                                                 self.root, event.src_path, event.dest_path)
+        else:
+            self.tracker.queue_structural_change(event.src_path, self.tracker.handle_file_moved,
+                                                 event.src_path, event.dest_path)
+
+class GitHeadHandler(FileSystemEventHandler):
+    def __init__(self, resolver: GitBranchResolver):
+        self.resolver = resolver
+    
+    def on_any_event(self, event):
+        # git replaces HEAD through HEAD.lock, so the rename destination is what matters
+        path = getattr(event, 'dest_path', '') or event.src_path
+        if os.path.basename(path) in ('HEAD', 'packed-refs'):
+            self.resolver.invalidate_git_dir(os.path.dirname(path))
 
 app = Flask(__name__)
+RUNTIME_INFO.refresh_async()
 config = WakaTimeConfig()
 tracker = FileTracker(config)
 
@@ -777,6 +3099,19 @@ def manual_heartbeat():
     tracker.handle_file_change(file_path, is_write=True)
     return jsonify({'message': f'Heartbeat queued for {file_path}'}), 200
 
+@app.route('/api/runtime', methods=['GET'])
+def get_runtime():
+    return jsonify({
+        'runtime_info': RUNTIME_INFO.get(),
+        'detected_at': RUNTIME_INFO.detected_at,
+        'user_agent': build_user_agent(config.editor_name)
+    })
+
+@app.route('/api/runtime', methods=['POST'])
+def refresh_runtime():
+    runtime_info = RUNTIME_INFO.refresh()
+    return jsonify({'message': 'Runtime info refreshed', 'runtime_info': runtime_info})
+
 @app.route('/api/config', methods=['GET'])
 def get_config():
     return jsonify({
@@ -794,6 +3129,15 @@ def get_config():
 def update_config():
     data = request.get_json()
     
+    if 'heartbeat_interval' in data:
+        try:
+            heartbeat_interval = max(1, int(data['heartbeat_interval']))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'heartbeat_interval must be a whole number of seconds'}), 400
+        config.heartbeat_interval = heartbeat_interval
+    # A bad key or URL may have pushed the sender into backoff; retrying with the old one is what failed
+    credentials_changed = (data.get('api_key', config.api_key) != config.api_key
+                           or data.get('api_url', config.api_url) != config.api_url)
     if 'api_key' in data:
         config.api_key = data['api_key']
     if 'api_url' in data:
@@ -802,10 +3146,12 @@ def update_config():
         config.project = data['project']
     if 'ide' in data:
         config.editor_name = data['ide'].lower()
-    if 'heartbeat_interval' in data:
-        config.heartbeat_interval = data['heartbeat_interval']
     
     config.save_wakatime_config()
+    tracker.reset_http_session()
+    if credentials_changed:
+        tracker.send_policy.reset()
+    tracker.reschedule_flush()
     
     return jsonify({'message': 'Configuration updated and saved'})
 